@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+from __future__ import print_function
+"""Non-interactive benchmarks of the primitives and of proving/verifying,
+over bitlengths and batch sizes. Results are written as JSON, and can be
+compared against a previous run's JSON to flag regressions, e.g.:
+
+python benchmark.py -o base.json
+(make changes)
+python benchmark.py -o new.json -b base.json
+
+Each benchmark is run --repeats times and the minimum (the least noisy
+estimate of the cost) and median wall clock times are recorded, along
+with the EC backend used (see ecbackend.py); --backend pins it.
+"""
+import os
+import sys
+import json
+import time
+import timeit
+import platform
+import argparse
+
+from jmbitcoin import decode, N
+
+from utils import derive_NUMS, getNUMS, nums_index
+from vectorpedersen import VPC
+from innerproduct import IPC
+from rangeproof import RangeProof, verify_batch
+import ecbackend
+
+DEFAULT_BITLENGTHS = [2, 4, 8, 16, 32, 64]
+DEFAULT_BATCH_SIZES = [1, 4, 16]
+
+def time_it(func, repeats):
+    """func is a setup function returning the function to be timed,
+    so that setup work isn't included. Runs it repeats times; returns
+    (min, median) of the durations in seconds.
+    """
+    times = []
+    for _ in range(repeats):
+        f = func()
+        start = timeit.default_timer()
+        f()
+        times.append(timeit.default_timer() - start)
+    times.sort()
+    return (times[0], times[len(times) // 2])
+
+def random_scalars(n):
+    return [decode(os.urandom(32), 256) % N for _ in range(n)]
+
+def bench_getNUMS(bitlength):
+    def setup():
+        #derive the generators for vectors of length bitlength, bypassing
+        #the registry so the search itself is measured
+        return lambda: [derive_NUMS(nums_index(i)) for i in range(2 * bitlength)]
+    return setup
+
+def bench_vpc_commitment(bitlength):
+    def setup():
+        vpc = VPC(random_scalars(bitlength), random_scalars(bitlength), vtype="int")
+        return vpc.get_commitment
+    return setup
+
+def bench_ipc_prove(bitlength):
+    def setup():
+        ipc = IPC(random_scalars(bitlength), random_scalars(bitlength), vtype="int")
+        ipc.get_commitment()
+        return ipc.generate_proof
+    return setup
+
+def bench_ipc_verify(bitlength):
+    ipc = IPC(random_scalars(bitlength), random_scalars(bitlength), vtype="int")
+    P = ipc.get_commitment()
+    a, b, L, R = ipc.generate_proof()
+    def setup():
+        verifier = IPC(["\x01"] * bitlength, ["\x02"] * bitlength)
+        return lambda: verifier.verify_proof(a, b, P, L, R)
+    return setup
+
+def make_proof(bitlength):
+    rp = RangeProof(bitlength)
+    rp.generate_proof(decode(os.urandom(8), 256) % 2**bitlength)
+    return (rp.get_proof_serialized(), rp.V, bitlength)
+
+def bench_rangeproof_prove(bitlength):
+    def setup():
+        rp = RangeProof(bitlength)
+        value = decode(os.urandom(8), 256) % 2**bitlength
+        return lambda: rp.generate_proof(value)
+    return setup
+
+def bench_rangeproof_verify(bitlength):
+    proof, V, bitlength = make_proof(bitlength)
+    def setup():
+        rp = RangeProof(bitlength)
+        args = rp.deserialize_proof(proof)
+        return lambda: rp.verify(*(args + (V,)))
+    return setup
+
+def bench_verify_batch(bitlength, batch_size):
+    proofs = [make_proof(bitlength) for _ in range(batch_size)]
+    def setup():
+        return lambda: verify_batch(proofs)
+    return setup
+
+def run_benchmarks(bitlengths, batch_sizes, repeats, log=print):
+    """Returns a list of result records: dicts with keys name,
+    bitlength, batch_size (or None), min, median (seconds).
+    """
+    results = []
+    def record(name, setup, bitlength, batch_size=None):
+        tmin, tmed = time_it(setup, repeats)
+        results.append({"name": name, "bitlength": bitlength,
+                        "batch_size": batch_size, "min": tmin, "median": tmed})
+        log("{:<22} n={:<3} batch={:<4} min={:.6f}s median={:.6f}s".format(
+            name, bitlength, batch_size if batch_size else "-", tmin, tmed))
+    #warm the generator registry so that only getNUMS pays for derivation
+    for bitlength in bitlengths:
+        [getNUMS(nums_index(i)) for i in range(2 * bitlength)]
+    for bitlength in bitlengths:
+        record("getNUMS", bench_getNUMS(bitlength), bitlength)
+        record("vpc_commitment", bench_vpc_commitment(bitlength), bitlength)
+        record("ipc_prove", bench_ipc_prove(bitlength), bitlength)
+        record("ipc_verify", bench_ipc_verify(bitlength), bitlength)
+        record("rangeproof_prove", bench_rangeproof_prove(bitlength), bitlength)
+        record("rangeproof_verify", bench_rangeproof_verify(bitlength), bitlength)
+        for batch_size in batch_sizes:
+            record("verify_batch", bench_verify_batch(bitlength, batch_size),
+                   bitlength, batch_size)
+    return results
+
+def result_key(r):
+    return (r["name"], r["bitlength"], r["batch_size"])
+
+def compare(results, baseline, threshold):
+    """Returns a list of (record, baseline record, ratio) for each result
+    whose minimum time is more than (1 + threshold) times the baseline's.
+    """
+    base = dict([(result_key(r), r) for r in baseline["results"]])
+    regressions = []
+    for r in results:
+        b = base.get(result_key(r))
+        if b and b["min"] > 0:
+            ratio = r["min"] / b["min"]
+            if ratio > 1 + threshold:
+                regressions.append((r, b, ratio))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulletproofs benchmarks")
+    parser.add_argument("-n", "--bitlengths", default=",".join(
+        [str(x) for x in DEFAULT_BITLENGTHS]), help="comma separated bitlengths")
+    parser.add_argument("-m", "--batch-sizes", default=",".join(
+        [str(x) for x in DEFAULT_BATCH_SIZES]), help="comma separated batch sizes")
+    parser.add_argument("-r", "--repeats", type=int, default=3)
+    parser.add_argument("-o", "--output", default=None,
+                        help="file to write JSON results to (default stdout)")
+    parser.add_argument("-b", "--baseline", default=None,
+                        help="JSON results of an earlier run to compare against")
+    parser.add_argument("-t", "--threshold", type=float, default=0.1,
+                        help="fractional slowdown against the baseline "
+                        "flagged as a regression")
+    parser.add_argument("-e", "--backend", default=None,
+                        help="EC backend to use (default: BULLETPROOFS_EC_BACKEND, "
+                        "or the fastest available; see ecbackend.py)")
+    args = parser.parse_args()
+    backend = ecbackend.set_backend(args.backend) if args.backend else ecbackend.get_backend()
+    bitlengths = [int(x) for x in args.bitlengths.split(",")]
+    batch_sizes = [int(x) for x in args.batch_sizes.split(",") if x]
+    log = lambda *a: print(*a, file=sys.stderr)
+    results = run_benchmarks(bitlengths, batch_sizes, args.repeats, log)
+    output = {"meta": {"time": time.time(), "python": platform.python_version(),
+                       "platform": platform.platform(), "repeats": args.repeats,
+                       "ecbackend": backend.name},
+              "results": results}
+    if args.output:
+        with open(args.output, "wb") as f:
+            json.dump(output, f, indent=2)
+    else:
+        print(json.dumps(output, indent=2))
+    if args.baseline:
+        with open(args.baseline, "rb") as f:
+            baseline = json.load(f)
+        base_backend = baseline["meta"].get("ecbackend")
+        if base_backend and base_backend != backend.name:
+            log("Warning: baseline used the {} EC backend, this run {}".format(
+                base_backend, backend.name))
+        regressions = compare(results, baseline, args.threshold)
+        for r, b, ratio in regressions:
+            log("REGRESSION {} n={} batch={}: {:.6f}s vs baseline {:.6f}s ({:.2f}x)".format(
+                r["name"], r["bitlength"], r["batch_size"], r["min"], b["min"], ratio))
+        if regressions:
+            sys.exit(1)
+        log("No regressions against", args.baseline)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+from __future__ import print_function
+"""Pluggable backends for the elliptic curve operations: point addition,
+scalar multiplication, multi-scalar multiplication and (de)serialization.
+Available are:
+
+pure: the pure Python Jacobian arithmetic of ecpoint.py, with the
+multiexp and fixed-base tables of utils.py; its points are ECPoints.
+jmbitcoin: jmbitcoin's multiply and add_pubkeys (secp256k1-py), with
+points as serializations.
+coincurve: the coincurve library (libsecp256k1), if installed.
+
+The rest of the code works with ECPoints throughout; utils.ecmult and
+utils.multiexp pass the work to the selected backend if it isn't the
+pure one (converting the points to and from uncompressed serializations,
+which needs no square roots). Additions aren't passed on: converting
+would cost more than adding.
+The backend is selected on first use by timing a small workload with
+each available one (so the conversions are included), unless the
+environment variable BULLETPROOFS_EC_BACKEND names one; set_backend
+changes it.
+"""
+import os
+import timeit
+
+from jmbitcoin import N, getG, podle_PublicKey
+
+from ecpoint import ECPoint, batch_normalize
+from scalar import to_bytes
+
+#not needed otherwise, so a stand-in jmbitcoin (see the README)
+#needn't provide them
+try:
+    from jmbitcoin import multiply, add_pubkeys
+except ImportError:
+    multiply = add_pubkeys = None
+try:
+    import coincurve
+except ImportError:
+    coincurve = None
+
+class ECBackend(object):
+    """The interface; points are of the backend's own type, with None
+    for the point at infinity (except for native, i.e. ECPoint, backends).
+    Scalars are integers in [0, N).
+    """
+    name = None
+    #whether the points are ECPoints, so that no conversion is needed
+    native = False
+
+    def parse(self, ser):
+        """Returns the point with 33 or 65 byte serialization ser;
+        raises ValueError if it isn't a valid point.
+        """
+        raise NotImplementedError
+
+    def serialize(self, P, compressed=True):
+        raise NotImplementedError
+
+    def add(self, P, Q):
+        raise NotImplementedError
+
+    def mult(self, k, P):
+        raise NotImplementedError
+
+    def msm(self, scalars, points):
+        """Returns sum_i scalars[i] * points[i].
+        """
+        acc = None
+        for k, P in zip(scalars, points):
+            acc = self.add(acc, self.mult(k, P))
+        return acc
+
+    def from_ecpoints(self, points):
+        batch_normalize(points)
+        return [None if P.is_infinity() else self.parse(P.serialize(False))
+                for P in points]
+
+    def to_ecpoint(self, P):
+        return ECPoint() if P is None else ECPoint.parse(self.serialize(P, False))
+
+class PureBackend(ECBackend):
+    name = "pure"
+    native = True
+
+    def parse(self, ser):
+        return ECPoint.parse(ser)
+
+    def serialize(self, P, compressed=True):
+        return P.serialize(compressed)
+
+    def add(self, P, Q):
+        return P.add(Q)
+
+    def mult(self, k, P):
+        return P.mult(k)
+
+    def msm(self, scalars, points):
+        from utils import multiexp_native
+        return multiexp_native(scalars, points)
+
+    def from_ecpoints(self, points):
+        return points
+
+    def to_ecpoint(self, P):
+        return P
+
+class JMBitcoinBackend(ECBackend):
+    """Points are kept as jmbitcoin keeps them, serialized (compressed).
+    """
+    name = "jmbitcoin"
+
+    def parse(self, ser):
+        try:
+            return podle_PublicKey(str(ser)).serialize()
+        except Exception as e:
+            raise ValueError("Invalid point: " + repr(e))
+
+    def serialize(self, P, compressed=True):
+        return P if compressed else podle_PublicKey(P).serialize(False)
+
+    def add(self, P, Q):
+        if P is None or Q is None:
+            return Q if P is None else P
+        try:
+            return add_pubkeys([P, Q], False)
+        except Exception:
+            #the sum is the point at infinity
+            return None
+
+    def mult(self, k, P):
+        k %= N
+        if k == 0 or P is None:
+            return None
+        return multiply(to_bytes(k), P, False)
+
+    def msm(self, scalars, points):
+        terms = [self.mult(k, P) for k, P in zip(scalars, points)]
+        terms = [P for P in terms if P is not None]
+        if not terms:
+            return None
+        try:
+            return add_pubkeys(terms, False) if len(terms) > 1 else terms[0]
+        except Exception:
+            return None
+
+    def from_ecpoints(self, points):
+        #valid already, so no need to go through parse
+        batch_normalize(points)
+        return [None if P.is_infinity() else P.serialize() for P in points]
+
+class CoincurveBackend(ECBackend):
+    name = "coincurve"
+
+    def parse(self, ser):
+        try:
+            return coincurve.PublicKey(str(ser))
+        except Exception as e:
+            raise ValueError("Invalid point: " + repr(e))
+
+    def serialize(self, P, compressed=True):
+        return P.format(compressed)
+
+    def add(self, P, Q):
+        if P is None or Q is None:
+            return Q if P is None else P
+        try:
+            return coincurve.PublicKey.combine_keys([P, Q])
+        except Exception:
+            return None
+
+    def mult(self, k, P):
+        k %= N
+        if k == 0 or P is None:
+            return None
+        return P.multiply(to_bytes(k))
+
+    def msm(self, scalars, points):
+        terms = [self.mult(k, P) for k, P in zip(scalars, points)]
+        terms = [P for P in terms if P is not None]
+        if not terms:
+            return None
+        try:
+            return coincurve.PublicKey.combine_keys(terms)
+        except Exception:
+            return None
+
+def available_backends():
+    backends = [PureBackend()]
+    if multiply and add_pubkeys:
+        backends.append(JMBitcoinBackend())
+    if coincurve:
+        backends.append(CoincurveBackend())
+    return backends
+
+#the selected backend; None until the first use
+current = None
+
+def benchmark_backend(backend, nterms=16, repeats=3):
+    """Returns the best of repeats timings of an nterms multiexp and a
+    scalar multiplication, as done through utils (so with any conversions).
+    """
+    G = ECPoint.parse(getG(True))
+    points = [G]
+    for _ in range(nterms - 1):
+        points.append(points[-1].double().add(G))
+    batch_normalize(points)
+    scalars = [(N - 1) // (i + 2) for i in range(nterms)]
+    times = []
+    for _ in range(repeats):
+        pts = [P.copy() for P in points]
+        start = timeit.default_timer()
+        backend.to_ecpoint(backend.msm(scalars, backend.from_ecpoints(pts)))
+        backend.to_ecpoint(backend.mult(scalars[0], backend.from_ecpoints(pts[:1])[0]))
+        times.append(timeit.default_timer() - start)
+    return min(times)
+
+def select_backend():
+    """Selects the backend named by BULLETPROOFS_EC_BACKEND if set,
+    otherwise the fastest available (see benchmark_backend); returns it.
+    """
+    global current
+    backends = available_backends()
+    name = os.environ.get("BULLETPROOFS_EC_BACKEND")
+    if name:
+        current = get_backend_by_name(name)
+        return current
+    timings = [(benchmark_backend(b), i) for i, b in enumerate(backends)]
+    current = backends[min(timings)[1]]
+    return current
+
+def get_backend_by_name(name):
+    for b in available_backends():
+        if b.name == name:
+            return b
+    raise ValueError("EC backend not available: " + name)
+
+def get_backend():
+    return current if current else select_backend()
+
+def set_backend(backend):
+    """backend is an ECBackend or the name of one.
+    """
+    global current
+    current = get_backend_by_name(backend) if isinstance(backend, str) else backend
+    return current
+
+def run_test_backends(bitlength=8, values=(5, 200)):
+    """Checks the primitives of each available backend against the pure
+    one, and that proofs made with each (from the same randomness) are
+    byte identical, and verify whichever backend is used.
+    """
+    global current
+    import hashlib
+    from rangeproof import RangeProof, verify_batch
+    saved = current
+    backends = available_backends()
+    G = ECPoint.parse(getG(True))
+    ks = [3, N - 1, 2**200 + 12345]
+    pts = [G.mult(k + 2) for k in ks]
+    expected = G.mult(sum([k * (k + 2) for k in ks]) % N)
+    for b in backends:
+        P = b.from_ecpoints([Q.copy() for Q in pts])
+        assert b.to_ecpoint(b.msm(ks, P)) == expected, b.name
+        assert b.to_ecpoint(b.add(P[0], P[1])) == pts[0].add(pts[1]), b.name
+        assert b.to_ecpoint(b.mult(ks[2], P[2])) == pts[2].mult(ks[2]), b.name
+        assert b.to_ecpoint(b.mult(N, P[0])).is_infinity(), b.name
+        negP = b.from_ecpoints([pts[0].neg()])[0]
+        assert b.to_ecpoint(b.add(P[0], negP)).is_infinity(), b.name
+        assert b.serialize(P[1], False) == pts[1].serialize(False), b.name
+        try:
+            b.parse("\x02" + "\xff" * 32)
+            assert False, "invalid point parsed by " + b.name
+        except ValueError:
+            pass
+    #the same randomness for each backend's proofs
+    class FakeUrandom(object):
+        def __init__(self):
+            self.counter = 0
+
+        def __call__(self, n):
+            self.counter += 1
+            return hashlib.sha256("urandom" + str(self.counter)).digest()[:n]
+    real_urandom = os.urandom
+    proofs = []
+    try:
+        for b in backends:
+            set_backend(b)
+            os.urandom = FakeUrandom()
+            try:
+                rp = RangeProof(bitlength, len(values))
+                rp.generate_proof(list(values))
+            finally:
+                os.urandom = real_urandom
+            proofs.append((rp.get_proof_serialized(), rp.V, bitlength))
+        assert all([p == proofs[0] for p in proofs]), "proofs differ between backends"
+        for b in backends:
+            set_backend(b)
+            assert verify_batch(proofs[:1] + [(proofs[0][0], proofs[0][1][::-1],
+                                               bitlength)]) == [True, False], b.name
+    finally:
+        #as it was, including not yet selected
+        current = saved
+    print("EC backend tests passed for:", ", ".join([b.name for b in backends]))
+    for b in backends:
+        print("{:<12} {:.6f}s".format(b.name, benchmark_backend(b)))
+
+if __name__ == "__main__":
+    #run via the imported module, which is the one utils sees
+    import ecbackend
+    ecbackend.run_test_backends()
+    print("Selected:", ecbackend.select_backend().name)
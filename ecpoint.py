@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+from __future__ import print_function
+"""secp256k1 points held in Jacobian coordinates (X, Y, Z), representing
+the affine point (X/Z^2, Y/Z^3), so that additions and doublings need
+no field inversions. Points are only converted to affine form (normalized)
+when they are serialized, e.g. into a proof or into a Fiat-Shamir hash;
+batch_normalize does this for many points with a single inversion.
+"""
+from scalar import to_bytes, from_bytes
+
+#the field prime
+P = 2**256 - 2**32 - 977
+
+class ECPoint(object):
+    """A point on secp256k1 (y^2 = x^3 + 7) in Jacobian coordinates;
+    Z = 0 is the point at infinity, which is the default constructed.
+    A point may carry a precomputed table for fixed-base multiplication
+    (see utils.FixedBaseTable), which mult() then uses.
+    """
+    __slots__ = ("X", "Y", "Z", "table")
+
+    def __init__(self, X=0, Y=1, Z=0):
+        self.X = X
+        self.Y = Y
+        self.Z = Z
+        self.table = None
+
+    @classmethod
+    def parse(cls, ser):
+        """Parses a compressed (33 byte) or uncompressed (65 byte)
+        serialization, checking that the point is on the curve;
+        raises ValueError otherwise.
+        """
+        if len(ser) == 33 and ser[0] in "\x02\x03":
+            x = from_bytes(ser[1:])
+            if x >= P:
+                raise ValueError("Invalid point: x not in field")
+            y2 = (x * x * x + 7) % P
+            y = pow(y2, (P + 1) // 4, P)
+            if (y * y) % P != y2:
+                raise ValueError("Invalid point: not on curve")
+            if (y & 1) != ord(ser[0]) - 2:
+                y = P - y
+            return cls(x, y, 1)
+        if len(ser) == 65 and ser[0] == "\x04":
+            x, y = from_bytes(ser[1:33]), from_bytes(ser[33:])
+            if x >= P or y >= P or (y * y - x * x * x - 7) % P:
+                raise ValueError("Invalid point: not on curve")
+            return cls(x, y, 1)
+        raise ValueError("Invalid point serialization")
+
+    def __reduce__(self):
+        #for pickling (e.g. to pool workers); any table is left behind
+        return (ECPoint, (self.X, self.Y, self.Z))
+
+    def is_infinity(self):
+        return self.Z == 0
+
+    def copy(self):
+        return ECPoint(self.X, self.Y, self.Z)
+
+    def normalize(self):
+        """Converts to affine form (Z = 1) in place; returns self.
+        """
+        if self.Z not in (0, 1):
+            zinv = pow(self.Z, P - 2, P)
+            zinv2 = (zinv * zinv) % P
+            self.X = (self.X * zinv2) % P
+            self.Y = (self.Y * zinv2 * zinv) % P
+            self.Z = 1
+        return self
+
+    def serialize(self, compressed=True):
+        """33 byte compressed (or 65 byte uncompressed) serialization;
+        the point at infinity has none, so raises ValueError.
+        """
+        if self.Z == 0:
+            raise ValueError("Cannot serialize the point at infinity")
+        self.normalize()
+        if not compressed:
+            return "\x04" + to_bytes(self.X) + to_bytes(self.Y)
+        return chr(2 + (self.Y & 1)) + to_bytes(self.X)
+
+    def __str__(self):
+        #Points are hashed (for Fiat-Shamir) and concatenated (for proofs)
+        #as their serialization.
+        return self.serialize()
+
+    def __repr__(self):
+        if self.Z == 0:
+            return "ECPoint(infinity)"
+        return "ECPoint(" + self.serialize().encode("hex") + ")"
+
+    def __eq__(self, other):
+        if isinstance(other, str):
+            return self.Z != 0 and self.serialize() == other
+        if not isinstance(other, ECPoint):
+            return False
+        if self.Z == 0 or other.Z == 0:
+            return self.Z == other.Z
+        z1s = (self.Z * self.Z) % P
+        z2s = (other.Z * other.Z) % P
+        return ((self.X * z2s - other.X * z1s) % P == 0 and
+                (self.Y * z2s * other.Z - other.Y * z1s * self.Z) % P == 0)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        if self.Z == 0:
+            return hash(None)
+        self.normalize()
+        return hash((self.X, self.Y))
+
+    def neg(self):
+        return ECPoint(self.X, (P - self.Y) % P, self.Z)
+
+    def double(self):
+        X, Y, Z = self.X, self.Y, self.Z
+        if Z == 0 or Y == 0:
+            return ECPoint()
+        YY = (Y * Y) % P
+        S = (4 * X * YY) % P
+        M = (3 * X * X) % P
+        X3 = (M * M - 2 * S) % P
+        Y3 = (M * (S - X3) - 8 * YY * YY) % P
+        Z3 = (2 * Y * Z) % P
+        return ECPoint(X3, Y3, Z3)
+
+    def add(self, other):
+        """Returns self + other. If other is affine (Z = 1), as generators
+        and table entries are, this is a cheaper mixed addition.
+        """
+        if self.Z == 0:
+            return other
+        if other.Z == 0:
+            return self
+        X1, Y1, Z1 = self.X, self.Y, self.Z
+        X2, Y2, Z2 = other.X, other.Y, other.Z
+        Z1Z1 = (Z1 * Z1) % P
+        U2 = (X2 * Z1Z1) % P
+        S2 = (Y2 * Z1 * Z1Z1) % P
+        if Z2 == 1:
+            U1 = X1
+            S1 = Y1
+        else:
+            Z2Z2 = (Z2 * Z2) % P
+            U1 = (X1 * Z2Z2) % P
+            S1 = (Y1 * Z2 * Z2Z2) % P
+        H = (U2 - U1) % P
+        r = (S2 - S1) % P
+        if H == 0:
+            if r == 0:
+                return self.double()
+            return ECPoint()
+        HH = (H * H) % P
+        HHH = (H * HH) % P
+        V = (U1 * HH) % P
+        X3 = (r * r - HHH - 2 * V) % P
+        Y3 = (r * (V - X3) - S1 * HHH) % P
+        Z3 = (Z1 * H) % P if Z2 == 1 else (Z1 * Z2 * H) % P
+        return ECPoint(X3, Y3, Z3)
+
+    def mult(self, k, w=4):
+        """Returns k * self, using the point's fixed-base table if it has
+        one, else a w-bit fixed window over a table of 1 .. 2^w - 1 times
+        the point (the table normalized to allow mixed additions).
+        """
+        if self.table:
+            return self.table.mult(k)
+        if k == 0 or self.Z == 0:
+            return ECPoint()
+        mults = [self]
+        for d in range(2, 1 << w):
+            mults.append(mults[-1].add(self))
+        batch_normalize(mults)
+        acc = ECPoint()
+        mask = (1 << w) - 1
+        for j in reversed(range((k.bit_length() + w - 1) // w)):
+            for _ in range(w):
+                acc = acc.double()
+            d = (k >> (w * j)) & mask
+            if d:
+                acc = acc.add(mults[d - 1])
+        return acc
+
+def batch_normalize(points):
+    """Normalizes all the (non-infinity) points in the list in place, with
+    one field inversion in total (Montgomery's trick), instead of one each.
+    """
+    todo = [p for p in points if p.Z not in (0, 1)]
+    if not todo:
+        return points
+    prefix = [1]
+    for p in todo:
+        prefix.append((prefix[-1] * p.Z) % P)
+    inv = pow(prefix[-1], P - 2, P)
+    for i in reversed(range(len(todo))):
+        p = todo[i]
+        zinv = (inv * prefix[i]) % P
+        inv = (inv * p.Z) % P
+        zinv2 = (zinv * zinv) % P
+        p.X = (p.X * zinv2) % P
+        p.Y = (p.Y * zinv2 * zinv) % P
+        p.Z = 1
+    return points
+
+def serialize_points(points):
+    """Serializes a list of points, normalizing them all in one batch.
+    """
+    batch_normalize(points)
+    return [p.serialize() for p in points]
@@ -8,10 +8,36 @@ indicate x is a vector.
 """
 import hashlib
 import binascii
+import multiprocessing
 
-from jmbitcoin import (multiply, add_pubkeys, encode, decode, N)
-from utils import (modinv, inner_product, halves, getNUMS)
+from jmbitcoin import (encode, decode, N)
+from utils import (inner_product, halves, multiexp, ecmult2, ecadd_pubkeys,
+                   batch_normalize)
+from ecpoint import ECPoint
+from scalar import inv, batch_inv, from_bytes, to_bytes
 from vectorpedersen import VPC
+from instrument import phase
+
+#In the parallel prover, work is split into chunks of at least this
+#many folds (or multiexp terms); a round too small to split is done
+#in this process, as shipping the points would cost more than it saves.
+PARALLEL_MIN_CHUNK = 8
+
+def _chunks(n, nchunks):
+    size = max(PARALLEL_MIN_CHUNK, (n + nchunks - 1) // nchunks)
+    return [(i, min(n, i + size)) for i in range(0, n, size)]
+
+def _multiexp_task(args):
+    scalars, points = args
+    return multiexp(scalars, points)
+
+def _fold_task(args):
+    """Folds a chunk of G* and H*: G'_i = x^-1 G_i + x G_(i+n/2) and
+    H'_i = x H_i + x^-1 H_(i+n/2).
+    """
+    x, xinv, gL, gR, hL, hR = args
+    return ([ecmult2(xinv, g1, x, g2) for g1, g2 in zip(gL, gR)],
+            [ecmult2(x, h1, xinv, h2) for h1, h2 in zip(hL, hR)])
 
 class IPC(VPC):
     """An object to encapsulate an inner product commitment,
@@ -28,20 +54,43 @@ class IPC(VPC):
         iteration, and commitment P. Returned is the value of the challenge and its
         modular inverse, as well as the squares of those values, both as
         integers and binary strings, for convenience.
+        If this IPC was bound to an enclosing transcript (see __init__), P is
+        already fixed by that transcript and is not hashed.
         """
-        xb = hashlib.sha256("".join([self.fsstate] + [str(_) for _ in [L, R, P]])).digest()
-        self.fsstate = xb
-        x = decode(xb, 256) % N
+        x, xb, xinv = self.get_challenge(L, R, P)
         x_sq = (x * x) % N
-        xinv = modinv(x, N)
         x_sq_inv = (xinv * xinv) % N
-        x_sqb, xinvb, x_sq_invb = [encode(_, 256, 32) for _ in [x_sq,
+        x_sqb, xinvb, x_sq_invb = [to_bytes(_) for _ in [x_sq,
                                                                 xinv, x_sq_inv]]
         return (x, xb, x_sq, x_sqb, xinv, xinvb, x_sq_inv, x_sq_invb)    
 
-    def __init__(self, a, b, vtype="bin", g=None, h=None, u=None):
+    def get_challenge(self, L, R, P):
+        """The hashing step of fiat_shamir, returning only the challenge
+        x as integer and as its hash digest, and its inverse as integer.
+        """
+        x, xb = self.hash_challenge(L, R, P)
+        return (x, xb, inv(x))
+
+    def hash_challenge(self, L, R, P):
+        """As get_challenge, without the inverse (for the verifier,
+        which inverts all the challenges at once).
+        """
+        data = [L, R] if self.transcript else [L, R, P]
+        batch_normalize([d for d in data if isinstance(d, ECPoint)])
+        xb = hashlib.sha256("".join([self.fsstate] + [str(_) for _ in data])).digest()
+        self.fsstate = xb
+        return (from_bytes(xb) % N, xb)
+
+    def __init__(self, a, b, vtype="bin", g=None, h=None, u=None, transcript=None):
+        """transcript optionally sets the initial Fiat-Shamir state, for when
+        the commitment P is a deterministic function of the transcript of an
+        enclosing protocol (as in the rangeproof). P is then not hashed in
+        each round, which means a verifier can derive every challenge from
+        L and R alone, without computing any intermediate P.
+        """
         super(IPC, self).__init__(a, b, vtype=vtype, g=g, h=h, u=u)
-        self.fsstate = ""
+        self.transcript = transcript
+        self.fsstate = transcript if transcript else ""
         self.get_inner_product()
         self.L = []
         self.R = []
@@ -50,19 +99,115 @@ class IPC(VPC):
         self.c = inner_product(self.a, self.b)
         return self.c
 
-    def generate_proof(self, P=None):
+    def update(self, a=None, b=None, c=None):
+        """As VPC.update, except that the blinding c is the inner product
+        <a*, b*>, so it can't be set, but is kept up to date, also at O(1)
+        per changed element. A proof made afterwards (generate_proof) is
+        of the updated a*, b*; proofs already made are unaffected.
+        """
+        assert c is None, "The inner product can't be set"
+        new_a, new_b, scalars, points = self._element_updates(a, b)
+        delta = sum([from_bytes(new_a.get(i, self.a[i])) * from_bytes(
+            new_b.get(i, self.b[i])) - from_bytes(self.a[i]) * from_bytes(self.b[i])
+                     for i in set(new_a) | set(new_b)]) % N
+        c = to_bytes((from_bytes(self.c) + delta) % N)
+        P = self._apply_updates(new_a, new_b, scalars + [delta], points + [self.U])
+        self.c = c
+        return P
+
+    def generate_proof(self, P=None, workers=None, pool=None):
         """Setup feed-in values to recursive proof creation.
+        If workers or pool is set, the generator folds and the L, R
+        multiexponentiations of each round are spread over a process
+        pool (see get_proof_iterative): pool can be any object with a
+        map(func, iterable) method, such as multiprocessing.Pool; if only
+        workers is set, a Pool of that many processes is created for
+        this proof. The proof is identical to the serial one.
         """
+        #a fresh transcript and L, R for each proof (new lists, as the
+        #earlier proofs hold the old ones)
+        self.fsstate = self.transcript if self.transcript else ""
+        self.L = []
+        self.R = []
         #Make sure that the root 'P' value is set:
         if P:
             self.P = P
         else:
             self.get_commitment()
-        return self.get_proof_recursive(self.a, self.b, self.P,
-                                        self.g, self.h, self.vlen)
+        if pool or not workers:
+            return self.get_proof_iterative(pool, workers)
+        pool = multiprocessing.Pool(workers)
+        try:
+            return self.get_proof_iterative(pool, workers)
+        finally:
+            pool.close()
+            pool.join()
+
+    def get_proof_iterative(self, pool=None, nchunks=None):
+        """Creates the same proof as get_proof_recursive, without
+        recursion or any new IPC objects: a*, b* are converted to integers
+        once, and a*, b*, G*, H* are folded in place, each round writing
+        the folded vectors over the lower half of the same buffers.
+        L and R are computed directly as the multiexponentiations:
+        L = <aL, GR> + <bR, HL> + <aL, bR>U
+        R = <aR, GL> + <bL, HR> + <aR, bL>U
+        With a pool, each round's L and R terms and G*, H* folds are cut
+        into chunks (about nchunks of each, by default the CPU count)
+        which are mapped over the pool; the partial sums of L and R are
+        then added here, and the folded chunks copied back in place.
+        """
+        if pool and not nchunks:
+            nchunks = multiprocessing.cpu_count()
+        a = [from_bytes(x) for x in self.a]
+        b = [from_bytes(x) for x in self.b]
+        g = list(self.g)
+        h = list(self.h)
+        P = self.P
+        n = self.vlen
+        while n > 1:
+            with phase("ipa.round"):
+                n2 = n // 2
+                cL = sum([a[i] * b[n2 + i] for i in range(n2)]) % N
+                cR = sum([a[n2 + i] * b[i] for i in range(n2)]) % N
+                Lterms = (a[:n2] + b[n2:n] + [cL], g[n2:n] + h[:n2] + [self.U])
+                Rterms = (a[n2:n] + b[:n2] + [cR], g[:n2] + h[n2:n] + [self.U])
+                parallel = pool and n2 > PARALLEL_MIN_CHUNK
+                if parallel:
+                    tasks = []
+                    for scalars, points in [Lterms, Rterms]:
+                        tasks.append([(scalars[i:j], points[i:j]) for i, j in _chunks(
+                            len(scalars), nchunks)])
+                    sums = pool.map(_multiexp_task, tasks[0] + tasks[1])
+                    self.L.append(ecadd_pubkeys(sums[:len(tasks[0])]))
+                    self.R.append(ecadd_pubkeys(sums[len(tasks[0]):]))
+                else:
+                    self.L.append(multiexp(*Lterms))
+                    self.R.append(multiexp(*Rterms))
+                x, xb, xinv = self.get_challenge(self.L[-1], self.R[-1], P)
+                for i in range(n2):
+                    a[i] = (x * a[i] + xinv * a[n2 + i]) % N
+                    b[i] = (xinv * b[i] + x * b[n2 + i]) % N
+                if parallel:
+                    chunks = _chunks(n2, nchunks)
+                    folded = pool.map(_fold_task, [(x, xinv, g[i:j], g[n2 + i:n2 + j],
+                                                    h[i:j], h[n2 + i:n2 + j]) for i, j in chunks])
+                    for (i, j), (gc, hc) in zip(chunks, folded):
+                        g[i:j] = gc
+                        h[i:j] = hc
+                else:
+                    for i in range(n2):
+                        g[i] = ecmult2(xinv, g[i], x, g[n2 + i])
+                        h[i] = ecmult2(x, h[i], xinv, h[n2 + i])
+                #P' is only needed for the next challenge, and isn't hashed
+                #when bound to a transcript:
+                if not self.transcript:
+                    P = multiexp([1, x * x, xinv * xinv], [P, self.L[-1], self.R[-1]])
+            n = n2
+        return (to_bytes(a[0]), to_bytes(b[0]), self.L, self.R)
 
     def get_proof_recursive(self, a, b, P, g, h, n):
-        """The prover starts with the full a*, b*, then recursively
+        """(Reference version; generate_proof uses get_proof_iterative.)
+        The prover starts with the full a*, b*, then recursively
         constructs the case n=1 where the proof is output in the form a', b',
         these are scalars, and c' = a' * b'. This will be checked by the verifier
         against the modified P', which the verifier can calculate independently,
@@ -89,17 +234,14 @@ class IPC(VPC):
         aprime = []
         bprime = []
         for i in range(n/2):
-            gprime.append(add_pubkeys([multiply(xinvb, g[i], False),
-                                       multiply(xb, g[i+n/2], False)], False))
-            hprime.append(add_pubkeys([multiply(xb, h[i], False),
-                                       multiply(xinvb, h[i+n/2], False)], False))
+            gprime.append(multiexp([xinv, x], [g[i], g[i+n/2]]))
+            hprime.append(multiexp([x, xinv], [h[i], h[i+n/2]]))
             aprime.append(encode((x * decode(a[i],
                         256) + xinv * decode(a[i + n/2], 256)) % N, 256, 32))
             bprime.append(encode((xinv * decode(b[i],
                         256) + x * decode(b[i + n/2], 256)) % N, 256, 32))
         
-        Pprime = add_pubkeys([P, multiply(x_sqb, self.L[-1], False),
-                              multiply(x_sq_invb, self.R[-1], False)], False)
+        Pprime = multiexp([1, x_sq, x_sq_inv], [P, self.L[-1], self.R[-1]])
         return self.get_proof_recursive(aprime, bprime, Pprime, gprime, hprime, n/2)
 
     def verify_proof(self, a, b, P, L, R):
@@ -113,10 +255,53 @@ class IPC(VPC):
         Returns True or False for verification.
         """
         self.verif_iter = 0
-        self.fsstate = ""
+        self.fsstate = self.transcript if self.transcript else ""
         return self.verify_proof_recursive(P, L, R, a, b,
                                            self.g, self.h, self.vlen)
 
+    def get_verification_scalars(self, L, R, P=None, invert=None):
+        """For the verifier: derives the challenges x_j of all rounds from
+        the proof's L and R lists, and returns (x_sq, x_sq_inv, s), where
+        x_sq and x_sq_inv are lists of x_j^2 and x_j^-2, and s is the vector
+        of section 6.2 of the paper, such that the fully folded generators
+        are G' = <s, G*> and H' = <s^-1, H*>; note s^-1 is s reversed.
+        Hence the check of verify_proof becomes the single equation:
+        P + sum(x_sq_j L_j + x_sq_inv_j R_j) = a <s, G*> + b <s^-1, H*> + ab U.
+        P is only needed (to be hashed) if there is no bound transcript.
+        The challenges are inverted together in one batch inversion; the
+        caller can have a list of other scalars (invert) inverted in the
+        same batch, in which case their inverses are returned as a fourth
+        element.
+        """
+        assert len(L) == len(R) and 2**len(L) == self.vlen
+        assert self.transcript or P, "unbound transcript requires P"
+        self.fsstate = self.transcript if self.transcript else ""
+        xs = []
+        for j in range(len(L)):
+            x, xb = self.hash_challenge(L[j], R[j], P)
+            xs.append(x)
+            if not self.transcript:
+                #the next challenge hashes P', which needs this inverse now
+                xsi = pow(inv(x), 2, N)
+                P = multiexp([1, x * x, xsi], [P, L[j], R[j]])
+        k = len(L)
+        inverses = batch_inv(xs + (invert if invert else []))
+        x_sq = [(x * x) % N for x in xs]
+        x_sq_inv = [(xinv * xinv) % N for xinv in inverses[:k]]
+        xinv_prod = 1
+        for xinv in inverses[:k]:
+            xinv_prod = (xinv_prod * xinv) % N
+        #Round j splits on bit (k-1-j) of the index, with the lower half
+        #folded with x_j^-1 and the upper half with x_j (for G*); so
+        #setting the highest bit b of i multiplies by x_(k-1-b)^2.
+        s = [xinv_prod]
+        for i in range(1, self.vlen):
+            b = i.bit_length() - 1
+            s.append((s[i - (1 << b)] * x_sq[k - 1 - b]) % N)
+        if invert:
+            return (x_sq, x_sq_inv, s, inverses[k:])
+        return (x_sq, x_sq_inv, s)
+
     def verify_proof_recursive(self, P, L, R, a, b, g, h, n):
         """The verifier starts with the lists of L and R values, then recursively
         constructs the case n=1 where the the verifier calculates the modified P',
@@ -139,13 +324,11 @@ class IPC(VPC):
         gprime = []
         hprime = []
         for i in range(n/2):
-            gprime.append(add_pubkeys([multiply(xinvb, g[i], False),
-                                       multiply(xb, g[i+n/2], False)], False))
-            hprime.append(add_pubkeys([multiply(xb, h[i], False),
-                                       multiply(xinvb, h[i+n/2], False)], False))
+            gprime.append(multiexp([xinv, x], [g[i], g[i+n/2]]))
+            hprime.append(multiexp([x, xinv], [h[i], h[i+n/2]]))
         
-        Pprime = add_pubkeys([P, multiply(x_sqb, L[self.verif_iter], False),
-                            multiply(x_sq_invb, R[self.verif_iter], False)], False)
+        Pprime = multiexp([1, x_sq, x_sq_inv], [P, L[self.verif_iter],
+                                                 R[self.verif_iter]])
         self.verif_iter += 1
         return self.verify_proof_recursive(Pprime, L, R, a, b, gprime, hprime, n/2)
 
@@ -155,16 +338,19 @@ def run_test_IPC():
     b = [encode(x, 256, 32) for x in range(9, 17)]
     ipc1 = IPC(a, b)
     comm1 = ipc1.get_commitment()
-    print('generated commitment: ', binascii.hexlify(comm1))
+    print('generated commitment: ', binascii.hexlify(str(comm1)))
     proof = ipc1.generate_proof()
+    ipc2 = IPC(a, b)
+    if proof != ipc2.get_proof_recursive(a, b, comm1, ipc2.g, ipc2.h, 8):
+        print("Iterative and recursive proofs differ; bug.")
     a, b, L, R = proof
     print('generated proof: ')
     print('a: ', binascii.hexlify(a))
     print('b: ', binascii.hexlify(b))
-    print('L: ', [binascii.hexlify(_) for _ in L])
-    print('R: ', [binascii.hexlify(_) for _ in R])
+    print('L: ', [binascii.hexlify(str(_)) for _ in L])
+    print('R: ', [binascii.hexlify(str(_)) for _ in R])
     print('Total byte length is: ',
-          len(a) + len(b) + len(L) * len(L[0]) + len(R) * len(R[0]))
+          len(a) + len(b) + len(L) * 33 + len(R) * 33)
     print('Length of L, R array: ', len(L))
     print("**NOW ATTEMPTING TO VERIFY: **")
     #Note that the 'a' and 'b' vectors in the following constructor are dummy
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+from __future__ import print_function
+"""Opt-in instrumentation of the hot paths: counts of calls to the
+primitive operations, and wall clock time spent in the named phases of
+proving and verifying. Usage:
+
+with instrumented() as stats:
+    rp.generate_proof(value)
+print(stats.report())
+
+The counted functions are only wrapped for the duration of the with block
+(the wrappers are swapped into this package's modules, see
+INSTRUMENTED_MODULES, and the originals put back afterwards), so when
+disabled counting costs nothing at all, and a phase() costs one call
+returning a shared no-op context manager. Other modules (and hashlib
+itself) are left alone, but within the package the patching is still
+process wide: only one instrumented() block may be active at a time (it
+is not reentrant, from the same or another thread), calls made by other
+threads while it is active are counted too, and work done in other
+processes (e.g. a process pool used by the prover) isn't counted.
+"""
+import sys
+import timeit
+import hashlib
+import threading
+from collections import defaultdict
+
+import jmbitcoin
+import utils
+import scalar
+from ecpoint import ECPoint
+
+#The modules whose calls are counted
+INSTRUMENTED_MODULES = ("rangeproof", "innerproduct", "utils", "vectorpedersen",
+                        "ecpoint", "scalar")
+
+#(owner, attribute name, label) of each counted operation; module level
+#functions are replaced in the INSTRUMENTED_MODULES, whether imported by
+#name or used through their module, methods on the class.
+COUNTED = [(utils, "ecmult", "ecmult"),
+           (utils, "ecadd_pubkeys", "ecadd_pubkeys"),
+           (utils, "multiexp", "multiexp"),
+           (utils, "getNUMS", "getNUMS"),
+           (utils, "getNUMS_point", "getNUMS_point"),
+           (utils, "modinv", "modinv"),
+           (hashlib, "sha256", "sha256"),
+           (jmbitcoin, "encode", "encode"),
+           (jmbitcoin, "decode", "decode"),
+           (scalar, "inv", "inv"),
+           (scalar, "batch_inv", "batch_inv"),
+           (scalar, "to_bytes", "to_bytes"),
+           (scalar, "from_bytes", "from_bytes"),
+           (ECPoint, "parse", "ECPoint.parse"),
+           (ECPoint, "serialize", "ECPoint.serialize")]
+
+class Stats(object):
+    """Collected by an instrumented() block: counts[op] is the number of
+    calls to op, timings[phase] the total seconds spent in phase, and
+    phase_counts[phase] the number of times it was entered.
+    """
+    def __init__(self):
+        self.counts = defaultdict(int)
+        self.timings = defaultdict(float)
+        self.phase_counts = defaultdict(int)
+
+    def as_dict(self):
+        return {"counts": dict(self.counts), "timings": dict(self.timings),
+                "phase_counts": dict(self.phase_counts)}
+
+    def report(self):
+        lines = ["{:<20} {:>10}".format("operation", "calls")]
+        for op, count in sorted(self.counts.items()):
+            lines.append("{:<20} {:>10}".format(op, count))
+        lines.append("")
+        lines.append("{:<20} {:>10} {:>12}".format("phase", "entered", "seconds"))
+        for phase, t in sorted(self.timings.items()):
+            lines.append("{:<20} {:>10} {:>12.6f}".format(
+                phase, self.phase_counts[phase], t))
+        return "\n".join(lines)
+
+#the Stats being collected, if an instrumented() block is active
+_active = None
+#held while patching or unpatching
+_lock = threading.Lock()
+
+class _NullPhase(object):
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        return False
+
+_null_phase = _NullPhase()
+
+class _Phase(object):
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = timeit.default_timer()
+        return self
+
+    def __exit__(self, *args):
+        self.stats.timings[self.name] += timeit.default_timer() - self.start
+        self.stats.phase_counts[self.name] += 1
+        return False
+
+def phase(name):
+    """Context manager timing the enclosed code as the named phase, if
+    instrumentation is enabled. Phases may nest; each is timed separately.
+    """
+    if _active is None:
+        return _null_phase
+    return _Phase(_active, name)
+
+def _counting(func, label, counts):
+    def wrapper(*args, **kwargs):
+        counts[label] += 1
+        return func(*args, **kwargs)
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+class _ModuleProxy(object):
+    """Stands in for a module (e.g. hashlib) in the instrumented modules,
+    with the counted functions replaced, so the module itself is untouched.
+    """
+    def __init__(self, module, wrapped):
+        self.__dict__.update(wrapped)
+        self._module = module
+
+    def __getattr__(self, name):
+        return getattr(self._module, name)
+
+def _patch(stats):
+    """Swaps counting wrappers in for the COUNTED operations; returns
+    the list of (owner, name, original) needed to undo it.
+    """
+    undo = []
+    modules = [sys.modules[m] for m in INSTRUMENTED_MODULES if m in sys.modules]
+    #wrappers of each owner module's functions, by name
+    wrappers = {}
+    for owner, name, label in COUNTED:
+        if isinstance(owner, type):
+            orig = owner.__dict__[name]
+            if isinstance(orig, classmethod):
+                wrapped = classmethod(_counting(orig.__func__, label, stats.counts))
+            else:
+                wrapped = _counting(orig, label, stats.counts)
+            setattr(owner, name, wrapped)
+            undo.append((owner, name, orig))
+            continue
+        orig = getattr(owner, name)
+        wrapped = _counting(orig, label, stats.counts)
+        wrappers.setdefault(owner, {})[name] = wrapped
+        for module in modules:
+            if getattr(module, name, None) is orig:
+                setattr(module, name, wrapped)
+                undo.append((module, name, orig))
+    #and where the owner module is used as such (hashlib.sha256)
+    for owner, wrapped in wrappers.items():
+        proxy = _ModuleProxy(owner, wrapped)
+        for module in modules:
+            for attr, value in module.__dict__.items():
+                if value is owner and module is not owner:
+                    setattr(module, attr, proxy)
+                    undo.append((module, attr, owner))
+    return undo
+
+class instrumented(object):
+    """Context manager enabling instrumentation within its block; returns
+    the Stats being collected.
+    """
+    def __enter__(self):
+        global _active
+        with _lock:
+            if _active is not None:
+                raise RuntimeError("Instrumentation is already active")
+            self.stats = Stats()
+            self.undo = _patch(self.stats)
+            _active = self.stats
+        return self.stats
+
+    def __exit__(self, *args):
+        global _active
+        with _lock:
+            _active = None
+            for owner, name, orig in reversed(self.undo):
+                setattr(owner, name, orig)
+        return False
+
+def run_test_instrument(value, rangebits):
+    import rangeproof
+    from rangeproof import RangeProof
+    rp = RangeProof(rangebits)
+    sha256 = hashlib.sha256
+    with instrumented() as stats:
+        rp.generate_proof(value)
+        #only this package's modules are patched
+        assert hashlib.sha256 is sha256 and rangeproof.hashlib is not hashlib
+    assert stats.counts["sha256"] > 0 and rangeproof.hashlib is hashlib
+    print("Proving:")
+    print(stats.report())
+    proof = rp.get_proof_serialized()
+    V = rp.V
+    with instrumented() as stats:
+        assert rp.verify(*(rp.deserialize_proof(proof) + (V,)))
+    print("\nVerifying:")
+    print(stats.report())
+    #everything must be back as it was
+    assert utils.ecmult.__module__ == "utils" and _active is None
+    assert ECPoint.__dict__["serialize"].__module__ == "ecpoint"
+    with instrumented() as stats:
+        pass
+    assert not stats.counts
+
+if __name__ == "__main__":
+    value = int(sys.argv[1]) if len(sys.argv) > 1 else 7
+    rangebits = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    #run via the imported module, which is the one rangeproof sees (when
+    #run as a script, this module is a separate copy, __main__)
+    import instrument
+    instrument.run_test_instrument(value, rangebits)
@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+from __future__ import print_function
+"""Multi-party computation of an aggregated rangeproof (section 4.5 of
+the paper): m parties, each holding one value v_j and its blinding gamma_j
+(so the commitment V_j = v_j G + gamma_j H), jointly make one aggregated
+proof of all m values, as rangeproof.RangeProof(bitlength, m) would, and
+verified the same way, without any party learning another's value.
+A dealer collects the parties' shares and computes the challenges:
+
+round 1: party j sends V_j, A_j and S_j, its commitments over its own
+slice of the generators G*, H* (j*n .. (j+1)*n - 1 of each, for n the
+bitlength); the dealer sums A and S and derives y, z from the transcript.
+round 2: party j sends T1_j, T2_j for its share of t(X), the sum of the
+<l_j(X), r_j(X)>; the dealer sums them and derives x.
+round 3: party j sends its shares of tau_x, mu and t, and its l_j(x),
+r_j(x), which the dealer concatenates into the l, r of the whole proof.
+
+The dealer then makes the inner product proof of <l, r> itself, which
+the paper allows since l and r reveal nothing of the values (its
+per-round variant only saves the dealer work, at log(mn) more rounds
+of messages). Party shares are checked as they come in (each t_j
+against T1_j, T2_j and V_j), and the finished proof is verified, so a
+party sending bad shares is caught and named.
+Parties only answer the rounds in order, and each only once: answering
+round 3 twice, for different x, would give away the party's value.
+
+Messages are JSON objects (points and scalars hex encoded); a Channel
+carries them from the dealer to a party. LocalChannel calls a Party in
+the same process (still through JSON), SocketChannel talks to a party
+run with serve_party, one JSON object per line, over TCP or a Unix socket.
+"""
+import os
+import sys
+import json
+import socket
+import binascii
+import threading
+import SocketServer
+
+from jmbitcoin import N
+
+from ecpoint import ECPoint
+from utils import (Vector, PowerVector, ecmult, multiexp_is_zero,
+                   getNUMS_point, getG_point, nums_index, ecadd_pubkeys)
+from vectorpedersen import VPC
+from rangeproof import RangeProof, serialize_proof, verify_batch, proof_length
+from scalar import to_bytes, from_bytes
+
+def _point_hex(P):
+    return binascii.hexlify(P.serialize())
+
+def _scalar_hex(k):
+    return binascii.hexlify(to_bytes(k % N))
+
+def _read_point(msg, key):
+    try:
+        return ECPoint.parse(binascii.unhexlify(msg[key]))
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError("Bad point " + key + ": " + repr(e))
+
+def _read_scalar(msg, key):
+    try:
+        b = binascii.unhexlify(msg[key])
+    except (KeyError, TypeError) as e:
+        raise ValueError("Bad scalar " + key + ": " + repr(e))
+    k = from_bytes(b)
+    if len(b) != 32 or k >= N:
+        raise ValueError("Bad scalar " + key)
+    return k
+
+def _read_vector(msg, key, n):
+    v = msg.get(key)
+    if not isinstance(v, list) or len(v) != n:
+        raise ValueError("Bad vector " + key)
+    return Vector([_read_scalar({key: x}, key) for x in v])
+
+def _random_scalar():
+    return from_bytes(os.urandom(32)) % N
+
+class Party(object):
+    """A holder of value, with blinding gamma (32 bytes, default random),
+    taking part in proofs for values of bitlength bits; its position j
+    and the number of parties m are set by the dealer's first message.
+    handle() takes a request and returns the reply; a Party makes one
+    proof only.
+    """
+    def __init__(self, value, bitlength, gamma=None):
+        assert 0 <= value < 2**bitlength
+        self.value = value
+        self.bitlength = bitlength
+        self.gamma = gamma if gamma else os.urandom(32)
+        H = getNUMS_point(255)
+        self.V = ecmult(value, getG_point()).add(ecmult(self.gamma, H))
+        #the round answered last
+        self.round = 0
+
+    def handle(self, msg):
+        rnd = msg.get("round")
+        if rnd != self.round + 1:
+            raise ValueError("Expected round " + str(self.round + 1))
+        reply = [self.round1, self.round2, self.round3][rnd - 1](msg)
+        self.round = rnd
+        return reply
+
+    def round1(self, msg):
+        self.j, self.m = int(msg["j"]), int(msg["m"])
+        if int(msg["bitlength"]) != self.bitlength or not 0 <= self.j < self.m:
+            raise ValueError("Bad parameters")
+        n, mn = self.bitlength, self.bitlength * self.m
+        g = [getNUMS_point(nums_index(self.j * n + i)) for i in range(n)]
+        h = [getNUMS_point(nums_index(mn + self.j * n + i)) for i in range(n)]
+        H = getNUMS_point(255)
+        self.aL = Vector(self.value, n)
+        self.aR = self.aL.subtract(1)
+        self.alpha = _random_scalar()
+        A = VPC(self.aL.v, self.aR.v, g=g, h=h, u=H, vtype="int")
+        A.set_blinding(c=self.alpha)
+        self.sL = Vector([_random_scalar() for _ in range(n)])
+        self.sR = Vector([_random_scalar() for _ in range(n)])
+        self.rho = _random_scalar()
+        S = VPC(self.sL.v, self.sR.v, g=g, h=h, u=H, vtype="int")
+        S.set_blinding(c=self.rho)
+        return {"V": _point_hex(self.V), "A": _point_hex(A.get_bit_commitment()),
+                "S": _point_hex(S.get_commitment())}
+
+    def round2(self, msg):
+        y, z = _read_scalar(msg, "y"), _read_scalar(msg, "z")
+        n = self.bitlength
+        self.z = z
+        #this party's slice of l(X) and r(X): y^n and the z^(2+j).2^n
+        #are the entries j*n .. (j+1)*n - 1 of those of the whole proof
+        yn = PowerVector(y, n).scalar_mult(pow(y, self.j * n, N))
+        zpow_twon = PowerVector(2, n).scalar_mult(pow(z, 2 + self.j, N))
+        self.l = [self.aL.subtract(z), self.sL]
+        self.r = [yn.hadamard_offset(self.aR, z, zpow_twon), yn.hadamard(self.sR)]
+        self.t1 = (self.l[0].inner_product(self.r[1]) +
+                   self.l[1].inner_product(self.r[0])) % N
+        self.t2 = self.l[1].inner_product(self.r[1])
+        self.tau1, self.tau2 = _random_scalar(), _random_scalar()
+        G, H = getG_point(), getNUMS_point(255)
+        return {"T1": _point_hex(ecmult(self.t1, G).add(ecmult(self.tau1, H))),
+                "T2": _point_hex(ecmult(self.t2, G).add(ecmult(self.tau2, H)))}
+
+    def round3(self, msg):
+        x = _read_scalar(msg, "x")
+        lx = self.l[0].add_scaled(self.l[1], x)
+        rx = self.r[0].add_scaled(self.r[1], x)
+        tau_x = (self.tau1 * x + self.tau2 * x * x + pow(
+            self.z, 2 + self.j, N) * from_bytes(self.gamma)) % N
+        return {"tau_x": _scalar_hex(tau_x), "mu": _scalar_hex(self.alpha + self.rho * x),
+                "t": _scalar_hex(lx.inner_product(rx)),
+                "l": [_scalar_hex(e) for e in lx.v], "r": [_scalar_hex(e) for e in rx.v]}
+
+class LocalChannel(object):
+    """Carries messages to a Party in this process (through JSON, as
+    over a socket).
+    """
+    def __init__(self, party):
+        self.party = party
+
+    def request(self, msg):
+        return json.loads(json.dumps(self.party.handle(json.loads(json.dumps(msg)))))
+
+    def close(self):
+        pass
+
+class SocketChannel(object):
+    """Carries messages to a party served by serve_party at address,
+    a (host, port) tuple or a Unix socket path.
+    """
+    def __init__(self, address):
+        family = socket.AF_INET if isinstance(address, tuple) else socket.AF_UNIX
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.connect(address)
+        self.f = self.sock.makefile("rwb")
+
+    def request(self, msg):
+        self.f.write(json.dumps(msg) + "\n")
+        self.f.flush()
+        line = self.f.readline()
+        if not line:
+            raise ValueError("Party closed the connection")
+        reply = json.loads(line)
+        if "error" in reply:
+            raise ValueError("Party refused: " + reply["error"])
+        return reply
+
+    def close(self):
+        self.sock.close()
+
+class _PartyHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in iter(lambda: self.rfile.readline(1 << 20), ""):
+            try:
+                reply = self.server.party.handle(json.loads(line))
+            except (ValueError, KeyError, TypeError) as e:
+                reply = {"error": repr(e)}
+            self.wfile.write(json.dumps(reply) + "\n")
+            self.wfile.flush()
+
+class _TCPPartyServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class _UnixPartyServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+def serve_party(party, address):
+    """Returns a server (call serve_forever()) answering the dealer's
+    requests for party on address, as for SocketChannel.
+    """
+    if isinstance(address, tuple):
+        server = _TCPPartyServer(address, _PartyHandler)
+    else:
+        server = _UnixPartyServer(address, _PartyHandler)
+    server.party = party
+    return server
+
+class Dealer(object):
+    """Runs the protocol with the parties reached through channels
+    (their number must be a power of 2), for values of bitlength bits.
+    """
+    def __init__(self, channels, bitlength):
+        self.channels = channels
+        self.bitlength = bitlength
+        self.m = len(channels)
+        self.rp = RangeProof(bitlength, self.m)
+
+    def _ask(self, msg):
+        replies = []
+        for j, c in enumerate(self.channels):
+            msg = dict(msg, j=j) if msg["round"] == 1 else msg
+            replies.append(c.request(msg))
+        return replies
+
+    def run(self, workers=None, pool=None):
+        """Returns (proof, Vs): the serialized aggregated proof and the
+        list of the parties' commitments, in order, to verify it against.
+        Raises ValueError if a party misbehaves. workers and pool are as
+        for RangeProof.generate_proof, for the inner product proof.
+        """
+        rp, n, m = self.rp, self.bitlength, self.m
+        replies = self._ask({"round": 1, "m": m, "bitlength": n})
+        self.Vs = [_read_point(r, "V") for r in replies]
+        self.As = [_read_point(r, "A") for r in replies]
+        self.Ss = [_read_point(r, "S") for r in replies]
+        A, S = ecadd_pubkeys(self.As), ecadd_pubkeys(self.Ss)
+        rp.fsstate = ""
+        rp.y, rp.z = rp.fiat_shamir(self.Vs + [A, S])
+        replies = self._ask({"round": 2, "y": _scalar_hex(rp.y), "z": _scalar_hex(rp.z)})
+        self.T1s = [_read_point(r, "T1") for r in replies]
+        self.T2s = [_read_point(r, "T2") for r in replies]
+        T1, T2 = ecadd_pubkeys(self.T1s), ecadd_pubkeys(self.T2s)
+        x = rp.fiat_shamir([T1, T2], nret=1)[0]
+        self.x = x
+        replies = self._ask({"round": 3, "x": _scalar_hex(x)})
+        self.shares = []
+        for j, r in enumerate(replies):
+            share = dict((k, _read_scalar(r, k)) for k in ("tau_x", "mu", "t"))
+            share["l"], share["r"] = _read_vector(r, "l", n), _read_vector(r, "r", n)
+            if share["l"].inner_product(share["r"]) != share["t"] or not self._check_t(
+                j, share):
+                raise ValueError("Party " + str(j) + " sent an invalid share of t")
+            self.shares.append(share)
+        rp.tau_x = sum([s["tau_x"] for s in self.shares]) % N
+        rp.mu = sum([s["mu"] for s in self.shares]) % N
+        rp.t = sum([s["t"] for s in self.shares]) % N
+        lx = Vector(sum([s["l"].v for s in self.shares], []))
+        rx = Vector(sum([s["r"].v for s in self.shares], []))
+        rp.prove_inner_product(lx, rx, workers, pool)
+        proof = serialize_proof(A, S, T1, T2, rp.tau_x, rp.mu, rp.t, rp.proof)
+        if not verify_batch([(proof, self.Vs, n)])[0]:
+            for j in range(m):
+                if not self._check_lr(j):
+                    raise ValueError("Party " + str(j) + " sent invalid l, r")
+            raise ValueError("The proof does not verify")
+        return (proof, self.Vs)
+
+    def _check_t(self, j, share):
+        """(61) for party j alone: t_j G + tau_x_j H = z^(2+j) V_j +
+        delta_j G + x T1_j + x^2 T2_j, where delta_j is party j's share
+        of delta(y, z).
+        """
+        y, z, x, n = self.rp.y, self.rp.z, self.x, self.bitlength
+        ysum = sum(PowerVector(y, n).scalar_mult(pow(y, j * n, N)).v)
+        delta = ((z - z * z) * ysum - pow(z, 3 + j, N) * (2**n - 1)) % N
+        return multiexp_is_zero(
+            [share["t"] - delta, share["tau_x"], -pow(z, 2 + j, N), -x, -x * x],
+            [getG_point(), getNUMS_point(255), self.Vs[j], self.T1s[j], self.T2s[j]])
+
+    def _check_lr(self, j):
+        """(62) for party j alone: its l_j, r_j open A_j + x S_j - z.G_(j) +
+        (z y^n_(j) + z^(2+j) 2^n) . H'_(j), with mu_j H as the blinding,
+        for H'_(j) party j's slice of the H'_i = y^-i H_i.
+        """
+        y, z, x, n, m = self.rp.y, self.rp.z, self.x, self.bitlength, self.m
+        share = self.shares[j]
+        yinv = pow(y, N - 2, N)
+        yinvn = PowerVector(yinv, n).scalar_mult(pow(yinv, j * n, N))
+        g = [getNUMS_point(nums_index(j * n + i)) for i in range(n)]
+        h = [getNUMS_point(nums_index(m * n + j * n + i)) for i in range(n)]
+        zpow = pow(z, 2 + j, N)
+        #coefficients of H_i: (z y^i + z^(2+j) 2^i) y^-i - r_i y^-i
+        hs = [(z + zpow * pow(2, i, N) * yi - r * yi) for i, (yi, r) in enumerate(
+            zip(yinvn.v, share["r"].v))]
+        return multiexp_is_zero(
+            [1, x, -share["mu"]] + [-z - l for l in share["l"].v] + hs,
+            [self.As[j], self.Ss[j], getNUMS_point(255)] + g + h)
+
+def prove_jointly(values, bitlength, gammas=None):
+    """Convenience: runs the protocol with a Party per value in this
+    process; returns (proof, Vs) as Dealer.run.
+    """
+    gammas = gammas if gammas else [None] * len(values)
+    parties = [Party(v, bitlength, g) for v, g in zip(values, gammas)]
+    return Dealer([LocalChannel(p) for p in parties], bitlength).run()
+
+def run_test_mpc(values, bitlength, path="/tmp/bp-mpc-test"):
+    m = len(values)
+    #in process
+    proof, Vs = prove_jointly(values, bitlength)
+    rp = RangeProof(bitlength, m)
+    assert len(proof) == proof_length(bitlength, m)
+    assert rp.verify(*(rp.deserialize_proof(proof) + (Vs,)))
+    assert verify_batch([(proof, Vs, bitlength), (proof, Vs[::-1], bitlength)]) == [
+        True, m == 1]
+    print("In-process MPC proof of", m, "values verified; length:", len(proof))
+    #over sockets, one server per party
+    parties = [Party(v, bitlength) for v in values]
+    servers = []
+    for j, p in enumerate(parties):
+        address = path + "." + str(j)
+        if os.path.exists(address):
+            os.remove(address)
+        server = serve_party(p, address)
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+        servers.append((server, address))
+    channels = [SocketChannel(a) for _, a in servers]
+    proof, Vs = Dealer(channels, bitlength).run()
+    assert [str(V) for V in Vs] == [str(p.V) for p in parties]
+    assert verify_batch([(proof, Vs, bitlength)]) == [True]
+    #a party answers each round only once
+    try:
+        channels[0].request({"round": 3, "x": _scalar_hex(2)})
+        assert False, "party answered a round twice"
+    except ValueError:
+        pass
+    for c in channels:
+        c.close()
+    for server, address in servers:
+        server.shutdown()
+        server.server_close()
+        os.remove(address)
+    print("Socket MPC proof of", m, "values verified.")
+    #a cheating party, committed to a value out of range but proving the
+    #in range bits of it, is caught and named
+    cheat = Party(5, bitlength)
+    cheat.V = ecmult(2**bitlength + 5, getG_point()).add(ecmult(cheat.gamma,
+                                                                 getNUMS_point(255)))
+    parties = [Party(v, bitlength) for v in values[:-1]] + [cheat]
+    try:
+        Dealer([LocalChannel(p) for p in parties], bitlength).run()
+        assert False, "out of range value was proven"
+    except ValueError as e:
+        assert "Party " + str(m - 1) in str(e), e
+        print("Cheating party rejected:", repr(e))
+    #one keeping <l, r> = t (so its share of t checks out), but not l, r
+    class ScalingParty(Party):
+        def round3(self, msg):
+            reply = Party.round3(self, msg)
+            reply["l"] = [_scalar_hex(2 * from_bytes(binascii.unhexlify(e)))
+                          for e in reply["l"]]
+            reply["r"] = [_scalar_hex((N + 1) // 2 * from_bytes(binascii.unhexlify(e)))
+                          for e in reply["r"]]
+            return reply
+    parties = [ScalingParty(values[0], bitlength)] + [
+        Party(v, bitlength) for v in values[1:]]
+    try:
+        Dealer([LocalChannel(p) for p in parties], bitlength).run()
+        assert False, "invalid l, r were accepted"
+    except ValueError as e:
+        assert "Party 0 sent invalid l, r" in str(e), e
+        print("Cheating party rejected:", repr(e))
+
+if __name__ == "__main__":
+    #python mpc.py rangebits value1 value2 [...]; a power of 2 of values
+    bitlength = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    values = [int(x) for x in sys.argv[2:]] if len(sys.argv) > 2 else [3, 100, 0, 255]
+    run_test_mpc(values, bitlength)
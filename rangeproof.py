@@ -2,20 +2,139 @@
 from __future__ import print_function
 """Partial implementation (for learning/POC) of:
 https://eprint.iacr.org/2017/1066 ("Bulletproofs").
-Only single rangeproofs, not aggregated.
+Single rangeproofs, and aggregated rangeproofs for a power of 2
+number of values (section 4.3).
 Only handles bitlengths that are powers of 2 up to 64.
 """
 import os
 import sys
 import hashlib
 import binascii
+import itertools
+import threading
+import multiprocessing
+import multiprocessing.pool
+import Queue
+from collections import deque
 
-from jmbitcoin import (getG, encode, decode, N)
+from jmbitcoin import (encode, N)
 
-from utils import (modinv, inner_product, halves, getNUMS, Vector, PowerVector,
-                   ecmult, ecadd_pubkeys)
+from utils import (modinv, inner_product, halves, Vector, PowerVector,
+                   ecmult, ecadd_pubkeys, nums_index, multiexp_is_zero,
+                   getNUMS_point, getG_point, batch_normalize,
+                   nums_registry, warm_generators, to_point)
+from ecpoint import ECPoint, serialize_points
 from vectorpedersen import PC, VPC
 from innerproduct import IPC
+from instrument import phase
+from scalar import from_bytes, to_bytes
+
+#Reasons for rejecting a proof, as reported by verify_tiered (and, for
+#the malformed ones, ProofFormatError.reason)
+REJECT_PARAMETERS = "parameters"
+REJECT_PROOF_TYPE = "proof_type"
+REJECT_LENGTH = "length"
+REJECT_POINT_ENCODING = "point_encoding"
+REJECT_SCALAR_RANGE = "scalar_range"
+REJECT_INVALID_POINT = "invalid_point"
+REJECT_COMMITMENT = "commitment"
+REJECT_EQUATION_61 = "equation_61"
+REJECT_VERIFICATION = "verification_equation"
+
+#The largest proofs verify_tiered (and the verification service) accept
+#by default: verification costs, and the generators kept, grow with
+#bitlength times the number of values.
+MAX_VALUES = 16
+MAX_PROOF_BITS = 64 * MAX_VALUES
+
+class ProofFormatError(ValueError):
+    """Raised by parse_proof for a malformed proof; reason is one of
+    the REJECT_* constants above.
+    """
+    def __init__(self, reason, message):
+        ValueError.__init__(self, message)
+        self.reason = reason
+
+class ProofData(object):
+    """A parsed rangeproof (see parse_proof): the points A, S, T1, T2
+    and the lists L, R of the inner product proof as ECPoints, and the
+    scalars tau_x, mu, t and the inner product proof's a, b as integers.
+    """
+    __slots__ = ("A", "S", "T1", "T2", "tau_x", "mu", "t", "a", "b", "L", "R")
+
+    def args(self):
+        """The arguments of RangeProof.verify (or verify_stepwise), less V.
+        """
+        return (self.A, self.S, self.T1, self.T2, self.tau_x, self.mu, self.t,
+                (self.a, self.b, self.L, self.R))
+
+def proof_length(bitlength, nvalues=1):
+    """The length of a serialized proof, see RangeProof.get_proof_serialized.
+    """
+    return 4 * 33 + 5 * 32 + 2 * 33 * ((bitlength * nvalues).bit_length() - 1)
+
+def serialize_proof(A, S, T1, T2, tau_x, mu, t, proof):
+    """The serialization of a rangeproof with the given points and
+    (integer) scalars, and proof the inner product proof (a, b, L, R)
+    as returned by IPC.generate_proof; see RangeProof.get_proof_serialized.
+    """
+    a, b, Ls, Rs = proof
+    A, S, T1, T2 = serialize_points([A, S, T1, T2])
+    return "".join([A, S, T1, T2] + [to_bytes(x) for x in [tau_x, mu, t]] + [
+        a, b] + serialize_points(Ls + Rs))
+
+def parse_proof(proofstr, bitlength, nvalues=1):
+    """Parses a serialized proof of nvalues values of bitlength bits,
+    returning a ProofData, or raising ProofFormatError (a ValueError)
+    if it is malformed.
+    The cheap checks (the length, the scalars being below N, and the
+    point prefix bytes) are all made before any point is decompressed
+    and checked to be on the curve, which costs a square root each, so
+    junk is rejected quickly. The proof is read through a memoryview,
+    so no substrings of it are copied.
+    """
+    n = bitlength * nvalues
+    if bitlength < 1 or nvalues < 1 or n & (n - 1):
+        raise ProofFormatError(REJECT_PARAMETERS,
+                               "Bitlength times number of values must be a power of 2")
+    try:
+        buf = memoryview(proofstr)
+    except TypeError:
+        raise ProofFormatError(REJECT_PROOF_TYPE, "Proof must be a byte string, not " +
+                               type(proofstr).__name__)
+    if len(buf) != proof_length(bitlength, nvalues):
+        raise ProofFormatError(REJECT_LENGTH, "Invalid proof length {} for {} value(s) "
+                               "of {} bits".format(len(buf), nvalues, bitlength))
+    k = n.bit_length() - 1
+    point_offsets = [0, 33, 66, 99] + [292 + 33 * i for i in range(2 * k)]
+    for i in point_offsets:
+        if buf[i] not in "\x02\x03":
+            raise ProofFormatError(REJECT_POINT_ENCODING,
+                                   "Invalid point prefix at offset " + str(i))
+    scalars = [from_bytes(buf[i:i + 32]) for i in range(132, 292, 32)]
+    if any([x >= N for x in scalars]):
+        raise ProofFormatError(REJECT_SCALAR_RANGE, "Proof scalar not below the group order")
+    try:
+        points = [ECPoint.parse(buf[i:i + 33]) for i in point_offsets]
+    except ValueError as e:
+        raise ProofFormatError(REJECT_INVALID_POINT, str(e))
+    proof = ProofData()
+    proof.A, proof.S, proof.T1, proof.T2 = points[:4]
+    proof.tau_x, proof.mu, proof.t, proof.a, proof.b = scalars
+    proof.L = points[4:4 + k]
+    proof.R = points[4 + k:]
+    return proof
+
+class Precomputation(object):
+    """The part of a proof that doesn't depend on the values proven (see
+    RangeProof.precompute): the blinding values gamma_j of the V_j, alpha
+    of A, rho, sL*, sR* of S, and tau1, tau2 of T1, T2, along with the
+    commitments or parts of commitments they determine: gamma_j H,
+    alpha H, S, tau1 H and tau2 H. A bundle must be used for one proof
+    only (reusing it would reveal the values), so it is marked used.
+    """
+    __slots__ = ("bitlength", "nvalues", "gammas", "gammaH", "alpha", "alphaH",
+                 "rho", "sL", "sR", "S", "tau1", "tau2", "tau1H", "tau2H", "used")
 
 class RangeProof(object):
     def fiat_shamir(self, data, nret=2):
@@ -24,104 +143,191 @@ class RangeProof(object):
         the requirement of basing the challenge on the transcript of the prover-verifier
         communication up to this point.
         """
+        batch_normalize([d for d in data if isinstance(d, ECPoint)])
         xb = hashlib.sha256("".join([self.fsstate] + [str(_) for _ in data])).digest()
         challenges = []
         for i in range(nret):
-            challenges.append(decode(xb, 256))
+            challenges.append(from_bytes(xb))
             xb = hashlib.sha256(xb).digest()
         self.fsstate = xb
         return challenges
 
     def get_blinding_vector(self):
         """Returns a vector of random elements in the group Zn,
-        length of vector is the bitlength of our value to be rangeproofed.
+        length of vector is the bitlength of our value to be rangeproofed
+        (times the number of values, for an aggregated proof).
         """
-        randints = [self.get_blinding_value() for _ in range(self.bitlength)]
+        randints = [self.get_blinding_value() for _ in range(self.vlen)]
         return Vector(randints)
 
     def get_blinding_value(self):
-        return decode(os.urandom(32), 256)
+        return from_bytes(os.urandom(32))
 
-    def __init__(self, bitlength):
+    def __init__(self, bitlength, nvalues=1):
+        """nvalues > 1 gives an aggregated proof that each of nvalues
+        values is in range; it must be a power of 2.
+        """
         self.fsstate = ""
         assert bitlength in [2, 4, 8, 16, 32, 64], "Bitlength must be power of 2 <= 64"
+        assert nvalues > 0 and nvalues & (nvalues - 1) == 0, \
+               "Number of values must be a power of 2"
         self.bitlength = bitlength
+        self.nvalues = nvalues
+        #length of the vectors aL, aR, l(X), r(X) and of G*, H*:
+        self.vlen = bitlength * nvalues
+
+    def get_zpow_twon(self):
+        """Returns the vector which is the concatenation over values j
+        (counting from 0) of z^(2+j) . 2^n, that is the sum over j of
+        z^(1+j) (0^(j-1)n || 2^n || 0^(m-j)n) in the paper's notation
+        (section 4.3); for a single value this is just z^2 . 2^n.
+        """
+        twon = PowerVector(2, self.bitlength).v
+        zpow = PowerVector(self.z, self.nvalues + 2).v[2:]
+        return Vector([(zj * t) % N for zj in zpow for t in twon])
+
+    def get_delta(self):
+        """delta(y, z) = (z - z^2) <1, y^mn> - sum_j z^(3+j) <1, 2^n>
+        """
+        yn = PowerVector(self.y, self.vlen)
+        return ((self.z - self.z2) * sum(yn.v) - (2**self.bitlength - 1) * sum(
+            PowerVector(self.z, self.nvalues + 3).v[3:])) % N
 
-    def generate_proof(self, value):
+    def precompute(self):
+        """Returns a Precomputation: everything in a proof by this object
+        that can be done before the values are known (the "offline" phase;
+        see generate_proof and PrecomputedProver).
+        """
+        H = getNUMS_point(255)
+        pre = Precomputation()
+        pre.bitlength = self.bitlength
+        pre.nvalues = self.nvalues
+        pre.gammas = [os.urandom(32) for _ in range(self.nvalues)]
+        pre.gammaH = [ecmult(g, H) for g in pre.gammas]
+        pre.alpha = self.get_blinding_value()
+        pre.alphaH = ecmult(pre.alpha, H)
+        pre.rho = self.get_blinding_value()
+        pre.sL = self.get_blinding_vector().v
+        pre.sR = self.get_blinding_vector().v
+        S = IPC(pre.sL, pre.sR, vtype="int", u=H)
+        S.set_blinding(c=pre.rho)
+        pre.S = S.get_commitment()
+        pre.tau1 = self.get_blinding_value()
+        pre.tau2 = self.get_blinding_value()
+        pre.tau1H = ecmult(pre.tau1, H)
+        pre.tau2H = ecmult(pre.tau2, H)
+        pre.used = False
+        return pre
+
+    def generate_proof(self, value, workers=None, pool=None, precomputed=None):
         """Given the value value, follow the algorithm laid out
         on p.16, 17 (section 4.2) of paper for prover side.
+        For an aggregated proof, value is a list of nvalues values
+        (section 4.3), and self.gamma, self.V are then lists too.
+        workers/pool optionally parallelize the inner product proof,
+        see IPC.generate_proof.
+        precomputed is an unused Precomputation for this bitlength and
+        number of values; without one, it is made here first.
         """
         self.fsstate = ""
+        values = value if isinstance(value, list) else [value]
+        assert len(values) == self.nvalues
         self.value = value
-        self.gamma = os.urandom(32)
-        pc = PC(encode(self.value, 256, minlen=32), blinding=self.gamma)
-        self.V = pc.get_commitment()
-        self.aL = Vector(value, self.bitlength)
-        self.aR = self.aL.subtract([1] * self.bitlength)
-        assert self.aL.hadamard(self.aR).v == Vector([0]*self.bitlength).v
-        assert self.aL.inner_product(PowerVector(2, self.bitlength)) == value
-        self.alpha = self.get_blinding_value()
-        self.A = IPC(self.aL.v, self.aR.v, vtype="int", u=getNUMS(255).serialize())
-        self.A.set_blinding(c=self.alpha)
-        self.A.get_commitment()
-        self.rho = self.get_blinding_value()
-        self.sL = self.get_blinding_vector()
-        self.sR = self.get_blinding_vector()
-        self.S = IPC(self.sL.v, self.sR.v, vtype="int", u=getNUMS(255).serialize())
-        self.S.set_blinding(c=self.rho)
-        self.S.get_commitment()
-        self.y, self.z = self.fiat_shamir([self.V, self.A.P, self.S.P])
+        with phase("prove.precompute"):
+            pre = precomputed if precomputed else self.precompute()
+        assert (pre.bitlength, pre.nvalues) == (self.bitlength, self.nvalues)
+        assert not pre.used, "Precomputation must not be reused"
+        pre.used = True
+        gammas = pre.gammas
+        G = getG_point()
+        Vs = [ecmult(v, G).add(gH) for v, gH in zip(values, pre.gammaH)]
+        self.gamma = gammas if isinstance(value, list) else gammas[0]
+        self.V = Vs if isinstance(value, list) else Vs[0]
+        self.aL = Vector(sum([Vector(v, self.bitlength).v for v in values], []))
+        self.aR = self.aL.subtract(1)
+        assert self.aL.hadamard(self.aR).v == Vector([0]*self.vlen).v
+        for j, v in enumerate(values):
+            assert Vector(self.aL.v[j * self.bitlength:(j + 1) * self.bitlength]
+                          ).inner_product(PowerVector(2, self.bitlength)) == v
+        with phase("prove.A/S"):
+            self.alpha = pre.alpha
+            self.A = IPC(self.aL.v, self.aR.v, vtype="int", u=getNUMS_point(255))
+            self.A.set_blinding(c=self.alpha)
+            self.A.get_bit_commitment(cU=pre.alphaH)
+            self.rho = pre.rho
+            self.sL = Vector(pre.sL)
+            self.sR = Vector(pre.sR)
+            self.S = pre.S
+        self.y, self.z = self.fiat_shamir(Vs + [self.A.P, self.S])
         self.z2 = (self.z * self.z) % N
-        self.zv = Vector([self.z] * self.bitlength)
         #construct l(X) and r(X) coefficients; l[0] = constant term, l[1] linear term,
         #same for r(X)
-        self.l = []
-        self.l.append(self.aL.subtract(self.zv))
-        self.l.append(self.sL)
-        self.yn = PowerVector(self.y, self.bitlength)
-        self.r = []
-        #0th coeff is y^n o (aR + z.1^n) + z^2 . 2^n
-        self.r.append(self.yn.hadamard(self.aR.add(self.zv)).add(
-            PowerVector(2, self.bitlength).scalar_mult(self.z2)))
-        self.r.append(self.yn.hadamard(self.sR))
-        #constant term of t(X) = <l(X), r(X)> is the inner product of the
-        #constant terms of l(X) and r(X)
-        self.t0 = self.l[0].inner_product(self.r[0])
-        self.t1 = (self.l[0].inner_product(self.r[1]) + (
-            self.l[1].inner_product(self.r[0]))) % N
-        self.t2 = self.l[1].inner_product(self.r[1])
-        self.tau1 = self.get_blinding_value()
-        self.tau2 = self.get_blinding_value()
-        self.T1 = PC(self.t1, blinding=self.tau1)
-        self.T2 = PC(self.t2, blinding=self.tau2)
-        self.x_1 = self.fiat_shamir([self.T1.get_commitment(),
-                                     self.T2.get_commitment()], nret=1)[0]
+        with phase("prove.t_poly"):
+            self.l = []
+            self.l.append(self.aL.subtract(self.z))
+            self.l.append(self.sL)
+            self.yn = PowerVector(self.y, self.vlen)
+            self.r = []
+            #0th coeff is y^n o (aR + z.1^n) + z^2 . 2^n
+            #(for aggregated, y^mn o (aR + z.1^mn) + sum_j z^(1+j) . (..|2^n|..))
+            self.r.append(self.yn.hadamard_offset(self.aR, self.z,
+                                                  self.get_zpow_twon()))
+            self.r.append(self.yn.hadamard(self.sR))
+            #constant term of t(X) = <l(X), r(X)> is the inner product of the
+            #constant terms of l(X) and r(X)
+            self.t0 = self.l[0].inner_product(self.r[0])
+            self.t1 = (self.l[0].inner_product(self.r[1]) + (
+                self.l[1].inner_product(self.r[0]))) % N
+            self.t2 = self.l[1].inner_product(self.r[1])
+        with phase("prove.T1/T2"):
+            self.tau1 = pre.tau1
+            self.tau2 = pre.tau2
+            self.T1 = ecmult(self.t1, G).add(pre.tau1H)
+            self.T2 = ecmult(self.t2, G).add(pre.tau2H)
+            self.x_1 = self.fiat_shamir([self.T1, self.T2], nret=1)[0]
         self.mu = (self.alpha + self.rho * self.x_1) % N
         self.tau_x = (self.tau1 * self.x_1 + self.tau2 * self.x_1 * self.x_1 + \
-                      self.z2 * decode(self.gamma, 256)) % N
+                      sum([pow(self.z, 2 + j, N) * from_bytes(g) for j, g in enumerate(
+                          gammas)])) % N
         #lx and rx are vector-valued first degree polynomials evaluated at
         #the challenge value self.x_1
-        self.lx = self.l[0].add(self.l[1].scalar_mult(self.x_1))
-        self.rx = self.r[0].add(self.r[1].scalar_mult(self.x_1))
+        self.lx = self.l[0].add_scaled(self.l[1], self.x_1)
+        self.rx = self.r[0].add_scaled(self.r[1], self.x_1)
         self.t = (self.t0 + self.t1 * self.x_1 + self.t2 * self.x_1 * self.x_1) % N
         assert self.t == self.lx.inner_product(self.rx)
         #Prover will now send tau_x, mu and t to verifier, and inner product argument
         #can be verified from this data.
-        self.hprime = []
-        self.yinv = modinv(self.y, N)
-        for i in range(1, self.bitlength + 1):
-            self.hprime.append(ecmult(pow(self.yinv, i-1, N), self.A.h[i-1], False))
+        self.prove_inner_product(self.lx, self.rx, workers, pool)
+
+    def prove_inner_product(self, lx, rx, workers=None, pool=None):
+        """Makes the inner product proof of <lx, rx> = t (as self.proof),
+        where the transcript so far is up to the challenge x, and self.y,
+        tau_x, mu and t are set; as the end of generate_proof, and for
+        the dealer of a multi-party proof (see mpc.py).
+        """
+        with phase("prove.hprime"):
+            self.hprime = []
+            self.yinv = modinv(self.y, N)
+            for i in range(1, self.vlen + 1):
+                self.hprime.append(ecmult(pow(self.yinv, i-1, N), getNUMS_point(
+                    nums_index(self.vlen + i - 1)), False))
+        self.lx = lx
+        self.rx = rx
         self.uchallenge = self.fiat_shamir([self.tau_x, self.mu, self.t], nret=1)[0]
-        self.U = ecmult(self.uchallenge, getG(True), False)
-        #On the prover side, need to construct an inner product argument:
-        self.iproof = IPC(self.lx.v, self.rx.v, vtype="int", h=self.hprime, u=self.U)
-        self.proof = self.iproof.generate_proof()
+        self.U = ecmult(self.uchallenge, getG_point(), False)
+        #On the prover side, need to construct an inner product argument;
+        #its P is fixed by the transcript so far, to which it is bound:
+        with phase("prove.ipa"):
+            self.iproof = IPC(self.lx.v, self.rx.v, vtype="int", h=self.hprime, u=self.U,
+                              transcript=self.fsstate)
+            self.proof = self.iproof.generate_proof(workers=workers, pool=pool)
         #At this point we have a valid data set, but here is included a
         #sanity check that the inner product proof we've generated, actually verifies:
-        self.iproof2 = IPC([1]*self.bitlength, [2]*self.bitlength, vtype="int",
-                           h=self.hprime, u=self.U)
-        ak,bk,lk,rk = self.proof
-        assert self.iproof2.verify_proof(ak, bk, self.iproof.get_commitment(), lk, rk)
+        with phase("prove.ipa_check"):
+            self.iproof2 = IPC([1]*self.vlen, [2]*self.vlen, vtype="int",
+                               h=self.hprime, u=self.U, transcript=self.fsstate)
+            ak,bk,lk,rk = self.proof
+            assert self.iproof2.verify_proof(ak, bk, self.iproof.get_commitment(), lk, rk)
 
     def get_proof_serialized(self):
         """Returns the serialization of the rangeproof that's been created.
@@ -129,94 +335,173 @@ class RangeProof(object):
         and all scalars are fixed length 32 bytes, including the (a,b)
         components of the inner product proof. The exception is L, R which are
         arrays of EC points, length log_2(bitlength).
-        So total size of proof is: 33*4 + 32*3 + (32*2 + 33*2*log_2(bitlength)).
+        So total size of proof is: 33*4 + 32*5 + 33*2*log_2(bitlength), for
+        A, S, T1, T2, then tau_x, mu, t, a, b, then L and R (see proof_length).
         This agrees with the last sentence of 4.2 in the paper.
+        An aggregated proof has the same layout, with L, R of length
+        log_2(bitlength * nvalues); the commitments V are not included.
         """
-        a, b, Ls, Rs = self.proof
-        tau_x_ser, mu_ser, t_ser = [encode(x, 256, 32) for x in [self.tau_x, self.mu, self.t]]
-        return "".join([self.A.P, self.S.P, self.T1.get_commitment(),
-                        self.T2.get_commitment(), tau_x_ser, mu_ser, t_ser, a, b] + Ls + Rs)
+        return serialize_proof(self.A.P, self.S, self.T1, self.T2, self.tau_x,
+                               self.mu, self.t, self.proof)
 
     def deserialize_proof(self, proofstr):
         """Extract the points and scalars as per comments
-        to get_proof_serialized; this is obviously dumb and
-        no appropriate sanity checking; TODO
+        to get_proof_serialized, as the arguments for verify (less V);
+        raises ValueError if the proof is malformed (see parse_proof).
+        """
+        return parse_proof(proofstr, self.bitlength, self.nvalues).args()
+
+    def verify(self, Ap, Sp, T1p, T2p, tau_x, mu, t, proof, V, reuse_challenges=False):
+        """Takes as input an already-deserialized rangeproof, along
+        with the pedersen commitment V to the value (not here known),
+        and checks if the proof verifies, as a single multiexponentiation
+        (see get_verification_terms). For an aggregated proof V is the
+        list of the commitments to each value.
+        reuse_challenges: see get_verification_terms.
+        """
+        with phase("verify.terms"):
+            scalars, points = self.get_verification_terms(Ap, Sp, T1p, T2p, tau_x,
+                                                          mu, t, proof, V, reuse_challenges)
+        with phase("verify.multiexp"):
+            return multiexp_is_zero(scalars, points)
+
+    def get_verification_terms(self, Ap, Sp, T1p, T2p, tau_x, mu, t, proof, V,
+                               reuse_challenges=False):
+        """Returns (scalars, points) such that the proof is valid if and only
+        if sum_i scalars[i] * points[i] is the point at infinity.
+        This collapses (61), the reconstruction of P (62) and the inner
+        product argument into one equation of 2n + 2log(n) + 7 terms
+        (2mn + 2log(mn) + 6 + m for an aggregated proof of m values),
+        using the s-vector form of the IPA check (section 6.2 of the paper,
+        and see IPC.get_verification_scalars): the folded generators are
+        <s, G*> and <s^-1, H'*> with H'_i = y^-i H_i, so the verifier never
+        builds hprime or any intermediate generator vector. (61) is added
+        with a random weight c, so that it can't be cancelled by the rest.
+        With reuse_challenges, y, z and x are those set by the last
+        set_challenges (or check_61) on this object, which must have been
+        for the same proof and V, rather than hashed again.
+        """
+        Vs = V if isinstance(V, list) else [V]
+        assert len(Vs) == self.nvalues
+        if reuse_challenges:
+            self.fsstate = self.fsstate_x
+        else:
+            self.set_challenges(Ap, Sp, T1p, T2p, Vs)
+        self.uchallenge = self.fiat_shamir([tau_x, mu, t], nret=1)[0]
+        n = self.vlen
+        a, b, L, R = proof
+        a, b = [from_bytes(x) if isinstance(x, str) else x for x in (a, b)]
+        #dummy vals for constructor of verifier IPC; only the challenges are used.
+        iproof = IPC(["\x01"]*n, ["\x02"]*n, transcript=self.fsstate)
+        #y^-1 is inverted in the same batch as the IPA challenges
+        with phase("verify.ipa_scalars"):
+            x_sq, x_sq_inv, s, (self.yinv,) = iproof.get_verification_scalars(
+                L, R, invert=[self.y])
+        yinvn = PowerVector(self.yinv, n)
+        zpow_twon = self.get_zpow_twon()
+        c = self.get_blinding_value() % N
+        delta = self.get_delta()
+        scalars = [1, self.x_1]
+        points = [Ap, Sp]
+        #G* and H*:
+        for i in range(n):
+            scalars.append(-self.z - a * s[i])
+            points.append(iproof.g[i])
+        for i in range(n):
+            scalars.append(self.z + yinvn.v[i] * (zpow_twon.v[i] - b * s[n-1-i]))
+            points.append(iproof.h[i])
+        scalars += x_sq + x_sq_inv
+        points += L + R
+        #G gets tU - abU (with U = uchallenge*G) and c(t - delta) from (61);
+        #H gets -mu and c*tau_x from (61)
+        scalars += [self.uchallenge * (t - a * b) + c * (t - delta),
+                    -mu + c * tau_x, -c * self.x_1, -c * self.x_1 * self.x_1]
+        points += [getG_point(), getNUMS_point(255), T1p, T2p]
+        #V_j gets -c z^(2+j) from (61)
+        scalars += [-c * pow(self.z, 2 + j, N) for j in range(self.nvalues)]
+        points += Vs
+        return ([x % N for x in scalars], points)
+
+    def set_challenges(self, Ap, Sp, T1p, T2p, Vs):
+        """Derives the challenges y, z and x as the prover did, keeping
+        the Fiat-Shamir state after x (fsstate_x), which the challenges
+        of the inner product argument follow from.
+        """
+        self.fsstate = ""
+        self.y, self.z = self.fiat_shamir(Vs + [Ap, Sp])
+        self.z2 = (self.z * self.z) % N
+        self.x_1 = self.fiat_shamir([T1p, T2p], nret=1)[0]
+        self.fsstate_x = self.fsstate
+
+    def check_61(self, Ap, Sp, T1p, T2p, tau_x, t, V):
+        """Checks only (61), t G + tau_x H = sum_j z^(2+j) V_j + delta(y, z) G
+        + x T1 + x^2 T2, for the challenges derived as in verify: a few
+        hashes and a multiexponentiation of 4 + m terms (two of them with
+        a fixed base), against 2mn + 2log(mn) + 6 + m for the full check.
+        Passing it doesn't mean the proof is valid, see verify_tiered;
+        verify can then reuse the challenges.
         """
-        Ap = proofstr[:33]
-        Sp = proofstr[33:66]
-        T1p = proofstr[66:99]
-        T2p = proofstr[99:132]
-        #these are to be passed in as integers:
-        tau_x = decode(proofstr[132:164], 256)
-        mu = decode(proofstr[164:196], 256)
-        t = decode(proofstr[196:228], 256)
-        a = proofstr[228:260]
-        b = proofstr[260:292]
-        import math
-        arraylen = int(math.log(self.bitlength, 2))
-        ctr = 292
-        Ls = []
-        Rs = []
-        for i in range(arraylen):
-            Ls.append(proofstr[ctr:ctr+33])
-            ctr += 33
-        for i in range(arraylen):
-            Rs.append(proofstr[ctr:ctr+33])
-            ctr+=33
-        return (Ap, Sp, T1p, T2p, tau_x, mu, t, (a, b, Ls, Rs))
-            
-
-    def verify(self, Ap, Sp, T1p, T2p, tau_x, mu, t, proof, V):
+        Vs = V if isinstance(V, list) else [V]
+        assert len(Vs) == self.nvalues
+        self.set_challenges(Ap, Sp, T1p, T2p, Vs)
+        return multiexp_is_zero(
+            [t - self.get_delta(), tau_x, -self.x_1, -self.x_1 * self.x_1] + [
+                -pow(self.z, 2 + j, N) for j in range(self.nvalues)],
+            [getG_point(), getNUMS_point(255), T1p, T2p] + Vs)
+
+    def verify_stepwise(self, Ap, Sp, T1p, T2p, tau_x, mu, t, proof, V):
         """Takes as input an already-deserialized rangeproof, along
         with the pedersen commitment V to the value (not here known),
-        and checks if the proof verifies.
+        and checks if the proof verifies, following the steps of the
+        paper directly: (61), then the reconstruction of P, then the
+        (recursive) inner product proof verification. Much slower
+        than verify(), but useful to see what is being checked.
         """
+        Vs = V if isinstance(V, list) else [V]
+        assert len(Vs) == self.nvalues
         #wipe FS state:
         self.fsstate = ""
         #compute the challenges to find y, z, x
-        self.y, self.z = self.fiat_shamir([V, Ap, Sp])
+        self.y, self.z = self.fiat_shamir(Vs + [Ap, Sp])
         self.z2 = (self.z * self.z) % N
-        self.zv = Vector([self.z] * self.bitlength)        
+        self.zv = Vector([self.z] * self.vlen)
         self.x_1 = self.fiat_shamir([T1p, T2p], nret=1)[0]
         self.hprime = []
         self.yinv = modinv(self.y, N)
-        for i in range(1, self.bitlength + 1):
-            self.hprime.append(ecmult(pow(self.yinv, i-1, N),getNUMS(
-                self.bitlength+i).serialize(), False))
+        for i in range(1, self.vlen + 1):
+            self.hprime.append(ecmult(pow(self.yinv, i-1, N),getNUMS_point(
+                nums_index(self.vlen+i-1)), False))
         #construction of verification equation (61)
-        onen = PowerVector(1, self.bitlength)
-        twon = PowerVector(2, self.bitlength)
-        yn = PowerVector(self.y, self.bitlength)
-        self.k = (yn.inner_product(onen) * -self.z2) % N
-        self.k = (self.k - (onen.inner_product(twon) * (pow(self.z, 3, N)))) % N
-        self.gexp = (self.k + self.z * onen.inner_product(yn)) % N
+        yn = PowerVector(self.y, self.vlen)
+        self.gexp = self.get_delta()
         self.lhs = PC(t, blinding=tau_x).get_commitment()
-        self.rhs = ecmult(self.gexp, getG(True), False)
-        self.vz2 = ecmult((self.z * self.z) % N, V, False)
+        self.rhs = ecmult(self.gexp, getG_point(), False)
+        #z^2 V, or for aggregated, sum_j z^(2+j) V_j
+        self.vz2 = ecadd_pubkeys([ecmult(pow(self.z, 2 + j, N), Vj, False) for j, Vj in enumerate(
+            Vs)], False)
         self.rhs = ecadd_pubkeys([self.rhs, self.vz2], False)
         self.rhs = ecadd_pubkeys([self.rhs, ecmult(self.x_1, T1p, False)], False)
         self.rhs = ecadd_pubkeys([self.rhs, ecmult(
             (self.x_1 *self.x_1) % N, T2p, False)], False)
         if not self.lhs == self.rhs:
             print("(61) verification check failed")
-            print(binascii.hexlify(self.lhs))
-            print(binascii.hexlify(self.rhs))
+            print(binascii.hexlify(str(self.lhs)))
+            print(binascii.hexlify(str(self.rhs)))
             return False
         #reconstruct P (62)
         self.P = Ap
         self.P = ecadd_pubkeys([ecmult(self.x_1, Sp, False), self.P], False)
         #now add g*^(-z)
-        for i in range(self.bitlength):
-            self.P = ecadd_pubkeys([ecmult(-self.z % N, getNUMS(i+1).serialize(),
+        for i in range(self.vlen):
+            self.P = ecadd_pubkeys([ecmult(-self.z % N, getNUMS_point(nums_index(i)),
                                            False), self.P], False)
         #zynz22n is the exponent of hprime
-        self.zynz22n = yn.scalar_mult(self.z).add(PowerVector(2,
-                                            self.bitlength).scalar_mult(self.z2))
-        for i in range(self.bitlength):
+        self.zynz22n = yn.scalar_mult(self.z).add(self.get_zpow_twon())
+        for i in range(self.vlen):
             self.P = ecadd_pubkeys([ecmult(self.zynz22n.v[i], self.hprime[i],
                                            False), self.P], False)
         self.uchallenge = self.fiat_shamir([tau_x, mu, t], nret=1)[0]
-        self.U = ecmult(self.uchallenge, getG(True), False)
+        self.U = ecmult(self.uchallenge, getG_point(), False)
         self.P = ecadd_pubkeys([ecmult(t, self.U, False), self.P], False)
         #P should now be : A + xS + -zG* + (zy^n+z^2.2^n)H'* + tU
         #One can show algebraically (the working is omitted from the paper)
@@ -224,18 +509,511 @@ class RangeProof(object):
         #(lx, rx) vectors (whose inner product is t), thus the variable 'proof'
         #can be passed into the IPC verify call, which should pass.
         #input to inner product proof is P.h^-(mu)
-        self.Pprime = ecadd_pubkeys([self.P, ecmult(-mu % N, getNUMS(255).serialize(),
+        self.Pprime = ecadd_pubkeys([self.P, ecmult(-mu % N, getNUMS_point(255),
                                                     False)], False)
         #Now we can verify the inner product proof
         a, b, L, R = proof
+        a, b = [to_bytes(x) if isinstance(x, (int, long)) else x for x in (a, b)]
         #dummy vals for constructor of verifier IPC
-        self.iproof = IPC(["\x01"]*self.bitlength, ["\x02"]*self.bitlength,
-                          h=self.hprime, u=self.U)
+        self.iproof = IPC(["\x01"]*self.vlen, ["\x02"]*self.vlen,
+                          h=self.hprime, u=self.U, transcript=self.fsstate)
         #self.iproof.P = self.Pprime
         if not self.iproof.verify_proof(a, b, self.Pprime, L, R):
             return False
         return True
 
+def _batch_is_valid(terms, indices):
+    """Sums the (already weighted) verification terms of the proofs at
+    indices into one multiexponentiation, merging the scalars of points
+    shared between proofs (G, H, and the G*, H* generators).
+    """
+    merged = {}
+    for i in indices:
+        for s, P in zip(*terms[i]):
+            merged[P] = (merged.get(P, 0) + s) % N
+    return multiexp_is_zero(merged.values(), merged.keys())
+
+def _batch_find_invalid(terms, indices, results):
+    """Called with a set of proofs whose combined check failed; bisects
+    to find the failing ones, marking them False in results.
+    """
+    if len(indices) == 1:
+        results[indices[0]] = False
+        return
+    half = len(indices) // 2
+    for part in [indices[:half], indices[half:]]:
+        if not _batch_is_valid(terms, part):
+            _batch_find_invalid(terms, part, results)
+
+def verify_batch(proofs, cache=None):
+    """Verifies a list of rangeproofs, each given as a tuple
+    (serialized proof, V, bitlength); bitlengths may differ, and a
+    proof is taken as aggregated if its V is a list of commitments.
+    The verification equations of all the proofs (see
+    RangeProof.get_verification_terms) are each multiplied by a random
+    weight and summed into a single multiexponentiation; since the
+    G*, H*, G and H terms are shared their scalars just add, so each
+    extra proof costs only its own ~2log(n) + 7 points.
+    If the combined check fails the batch is bisected to find which
+    proofs are invalid. Returns a list of True/False, in input order.
+    cache is an optional verifycache.VerificationCache: proofs found in
+    it are taken as valid without any EC work, and valid ones are added.
+    """
+    return _verify_batch(proofs, cache)[0]
+
+def _verify_batch(proofs, cache=None):
+    """As verify_batch, but returns (results, errors), where errors has
+    a description of the exception for each proof that failed to parse.
+    """
+    results = [True] * len(proofs)
+    errors = [None] * len(proofs)
+    keys = [cache.key(*p) for p in proofs] if cache is not None else None
+    terms = {}
+    for i, (proofstr, V, bitlength) in enumerate(proofs):
+        if keys and cache.check(keys[i]):
+            continue
+        try:
+            rp = RangeProof(bitlength, len(V) if isinstance(V, list) else 1)
+            scalars, points = rp.get_verification_terms(
+                *(rp.deserialize_proof(proofstr) + (V,)))
+        except Exception as e:
+            results[i] = False
+            errors[i] = repr(e)
+            continue
+        w = rp.get_blinding_value() % N
+        terms[i] = ([(w * x) % N for x in scalars], points)
+    indices = sorted(terms.keys())
+    if indices and not _batch_is_valid(terms, indices):
+        _batch_find_invalid(terms, indices, results)
+    if keys:
+        for i in indices:
+            if results[i]:
+                cache.add(keys[i])
+    return (results, errors)
+
+class VerificationResult(object):
+    """The outcome of verify_tiered: valid, the stage reached (1, 2 or 3;
+    for a valid proof, the last one run), and for a rejected proof reason,
+    one of the REJECT_* constants, and detail, a description. True in a
+    boolean context if valid.
+    """
+    __slots__ = ("valid", "stage", "reason", "detail")
+
+    def __init__(self, valid, stage, reason=None, detail=None):
+        self.valid = valid
+        self.stage = stage
+        self.reason = reason
+        self.detail = detail
+
+    def __nonzero__(self):
+        return self.valid
+
+    def __repr__(self):
+        return "VerificationResult(valid={}, stage={}, reason={!r}, detail={!r})".format(
+            self.valid, self.stage, self.reason, self.detail)
+
+def verify_tiered(proofstr, V, bitlength, check61=True, max_values=MAX_VALUES,
+                  max_bits=MAX_PROOF_BITS, last_stage=3):
+    """Verifies a serialized proof against V (a list for an aggregated
+    proof) in stages of increasing cost, stopping at the first failure,
+    so that a bad proof costs as little as its defect allows:
+    1: structure (see parse_proof): the parameters and length, the point
+    prefixes and the scalars being below N (no EC work at all), then
+    the points, and V, being on the curve (a square root each);
+    2 (if check61): (61) alone, see RangeProof.check_61;
+    3: the full check, as RangeProof.verify (with the challenges of
+    stage 2, if it was run).
+    Proofs of more than max_values values, or of more than max_bits
+    bits in all, are rejected as REJECT_PARAMETERS before anything else.
+    With last_stage 1 or 2 the later stages are skipped, as a cheap
+    filter (e.g. before queueing the proof for batch verification); a
+    valid result then only means the proof passed the stages run.
+    Returns a VerificationResult; nothing is printed or raised for a bad
+    proof.
+    """
+    nvalues = len(V) if isinstance(V, list) else 1
+    if bitlength not in [2, 4, 8, 16, 32, 64] or nvalues & (nvalues - 1):
+        return VerificationResult(False, 1, REJECT_PARAMETERS,
+                                  "Unsupported bitlength or number of values")
+    if nvalues > max_values or bitlength * nvalues > max_bits:
+        return VerificationResult(False, 1, REJECT_PARAMETERS,
+                                  "Proof too large: {} value(s) of {} bits".format(
+                                      nvalues, bitlength))
+    try:
+        parsed = parse_proof(proofstr, bitlength, nvalues)
+    except ProofFormatError as e:
+        return VerificationResult(False, 1, e.reason, str(e))
+    try:
+        Vs = [to_point(x) for x in (V if isinstance(V, list) else [V])]
+        if any([x.is_infinity() for x in Vs]):
+            raise ValueError("Commitment is the point at infinity")
+    except (ValueError, TypeError) as e:
+        return VerificationResult(False, 1, REJECT_COMMITMENT, str(e))
+    if last_stage == 1:
+        return VerificationResult(True, 1)
+    rp = RangeProof(bitlength, nvalues)
+    args = parsed.args()
+    if check61:
+        if not rp.check_61(*(args[:5] + (args[6], Vs))):
+            return VerificationResult(False, 2, REJECT_EQUATION_61,
+                                      "t, tau_x, T1, T2 do not match the commitments")
+    if last_stage == 2:
+        return VerificationResult(True, 2 if check61 else 1)
+    if not rp.verify(*(args + (Vs if isinstance(V, list) else Vs[0], check61))):
+        return VerificationResult(False, 3, REJECT_VERIFICATION,
+                                  "The combined (61), (62) and inner product check failed")
+    return VerificationResult(True, 3)
+
+def _pool_initializer(generator_file, n):
+    """Warms a new worker's generator state (see utils.warm_generators),
+    loading the generators from generator_file first if given.
+    """
+    if generator_file:
+        nums_registry.load(generator_file)
+    warm_generators(n)
+
+def make_pool(workers=None, bitlength=64, nvalues=1, generator_file=None):
+    """Returns a multiprocessing.Pool of workers (default: CPU count)
+    each of which starts with the generators for proofs of bitlength and
+    nvalues, and the fixed-base tables, ready. generator_file is a file
+    written by NUMSRegistry.save (e.g. by python utils.py filename n), to
+    avoid deriving the generators at all; a version 2 file also holds the
+    tables, and is memory-mapped, so it's shared by all the workers.
+    """
+    return multiprocessing.Pool(workers, _pool_initializer,
+                                (generator_file, bitlength * nvalues))
+
+def _precompute_task(args):
+    bitlength, nvalues = args
+    return RangeProof(bitlength, nvalues).precompute()
+
+class PrecomputedProver(object):
+    """Proves with the value independent work done ahead of time (the
+    offline/online split): Precomputations for proofs of nvalues values
+    of bitlength bits are made in a process pool (as for make_pool,
+    unless one is passed in) and kept in a queue of at most size bundles,
+    so that prove() only has the work that depends on the values left.
+    Up to workers bundles are made at a time, each by a thread waiting on
+    the pool; a thread blocks while the queue is full. If the queue is
+    empty when a proof is wanted, the bundle is just made there and then.
+    Call close() (or use as a context manager) to stop.
+    """
+    def __init__(self, bitlength, nvalues=1, size=16, workers=None, pool=None,
+                 generator_file=None):
+        self.bitlength = bitlength
+        self.nvalues = nvalues
+        self.queue = Queue.Queue(size)
+        self.own_pool = not pool
+        self.pool = pool if pool else make_pool(workers, bitlength, nvalues,
+                                                generator_file)
+        self.stopped = threading.Event()
+        self.threads = []
+        for _ in range(workers if workers else multiprocessing.cpu_count()):
+            t = threading.Thread(target=self._fill)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def _fill(self):
+        while not self.stopped.is_set():
+            try:
+                pre = self.pool.apply(_precompute_task,
+                                      ((self.bitlength, self.nvalues),))
+            except Exception:
+                #the pool was closed under us (apply then fails its
+                #assertion that it's running); anything else is a bug
+                if self.pool._state != multiprocessing.pool.RUN:
+                    return
+                raise
+            while not self.stopped.is_set():
+                try:
+                    self.queue.put(pre, timeout=0.1)
+                    break
+                except Queue.Full:
+                    continue
+
+    def prove(self, value, workers=None, pool=None):
+        """Returns the RangeProof object, with the proof of value (or of the
+        list of values) generated; workers, pool are as for generate_proof.
+        """
+        try:
+            pre = self.queue.get_nowait()
+        except Queue.Empty:
+            pre = None
+        rp = RangeProof(self.bitlength, self.nvalues)
+        rp.generate_proof(value, workers=workers, pool=pool, precomputed=pre)
+        return rp
+
+    def close(self):
+        self.stopped.set()
+        for t in self.threads:
+            t.join()
+        if self.own_pool:
+            self.pool.close()
+            self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
+
+def _prove_task(args):
+    value, bitlength = args
+    try:
+        rp = RangeProof(bitlength, len(value) if isinstance(value, list) else 1)
+        rp.generate_proof(value)
+        if isinstance(value, list):
+            return (rp.get_proof_serialized(), [str(V) for V in rp.V], rp.gamma, None)
+        return (rp.get_proof_serialized(), str(rp.V), rp.gamma, None)
+    except Exception as e:
+        return (None, None, None, repr(e))
+
+def _verify_task(shard):
+    results, errors = _verify_batch(shard)
+    return zip(results, errors)
+
+def _max_nvalues(entries):
+    #the most values in one (aggregated) proof of entries
+    return max([len(e) if isinstance(e, list) else 1 for e in entries])
+
+def _run_in_pool(func, tasks, workers, pool, chunksize, generator_file, bitlength,
+                 nvalues):
+    if pool:
+        return pool.map(func, tasks, chunksize)
+    pool = make_pool(workers, bitlength, nvalues, generator_file)
+    try:
+        return pool.map(func, tasks, chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
+def prove_many(values, bitlength, workers=None, pool=None, generator_file=None):
+    """Creates a rangeproof for each of values, sharded over a process
+    pool: the given pool (e.g. from make_pool, to keep workers warm across
+    calls) or else a new one of workers processes. An entry of values can
+    be a list, for an aggregated proof of those values.
+    Returns, in input order, a tuple (proof, V, gamma, error) for each
+    value, where proof is serialized, V is the serialized commitment (list
+    for aggregated) and gamma its blinding. If that proof failed, error
+    is a description of the exception and the rest are None; the others
+    are unaffected.
+    """
+    if not values:
+        return []
+    nworkers = workers or multiprocessing.cpu_count()
+    chunksize = max(1, len(values) // (4 * nworkers))
+    return _run_in_pool(_prove_task, [(v, bitlength) for v in values], workers,
+                        pool, chunksize, generator_file, bitlength,
+                        _max_nvalues(values))
+
+def verify_many(proofs, commitments, bitlength, workers=None, pool=None,
+                generator_file=None, shard_size=16, cache=None):
+    """Verifies serialized proofs against commitments (V, or a list of
+    the V's for an aggregated proof), all of the same bitlength, using a
+    process pool as for prove_many. Each worker checks shards of up to
+    shard_size proofs with verify_batch.
+    Returns, in input order, a tuple (valid, error) for each proof; error
+    describes the exception if one was raised while reading the proof,
+    in which case valid is False, and is otherwise None.
+    cache is as for verify_batch; it is consulted and updated here,
+    so only the proofs not found in it are sent to the pool.
+    """
+    items = [(p, V, bitlength) for p, V in zip(proofs, commitments)]
+    assert len(items) == len(proofs) == len(commitments)
+    keys = [cache.key(*item) for item in items] if cache is not None else None
+    todo = [i for i in range(len(items)) if not (keys and cache.check(keys[i]))]
+    results = [(True, None)] * len(items)
+    if not todo:
+        return results
+    todo_items = [items[i] for i in todo]
+    shards = [todo_items[i:i + shard_size] for i in range(0, len(todo), shard_size)]
+    shard_results = _run_in_pool(_verify_task, shards, workers, pool, 1, generator_file,
+                                 bitlength, _max_nvalues([V for _, V, _ in todo_items]))
+    for i, result in zip(todo, itertools.chain.from_iterable(shard_results)):
+        results[i] = result
+        if keys and result[0]:
+            cache.add(keys[i])
+    return results
+
+def read_proofs(source):
+    """Yields the (proof, V, bitlength) tuples in source, a file name or
+    an iterable of lines (e.g. an open file), one proof per line as
+    "proof V bitlength", with proof and V hex encoded, and V a comma
+    separated list for an aggregated proof; blank lines and lines
+    starting with # are skipped. Raises ValueError on a malformed line.
+    """
+    f = open(source) if isinstance(source, str) else source
+    try:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                proof, V, bitlength = line.split()
+                Vs = [binascii.unhexlify(x) for x in V.split(",")]
+                yield (binascii.unhexlify(proof), Vs if "," in V else Vs[0],
+                       int(bitlength))
+            except (ValueError, TypeError) as e:
+                raise ValueError("Malformed proof at line " + str(lineno) + ": " + repr(e))
+    finally:
+        if f is not source:
+            f.close()
+
+def write_proofs(f, proofs):
+    """Writes (proof, V, bitlength) tuples to the open file f in the
+    format read by read_proofs.
+    """
+    for proof, V, bitlength in proofs:
+        Vs = V if isinstance(V, list) else [V]
+        f.write("%s %s %d\n" % (binascii.hexlify(proof), ",".join(
+            [binascii.hexlify(str(x)) for x in Vs]), bitlength))
+
+def verify_stream(proofs, workers=None, pool=None, batch_size=64, max_inflight=None,
+                  bitlength=64, generator_file=None, cache=None):
+    """Verifies the (proof, V, bitlength) tuples of the iterable proofs
+    (e.g. read_proofs(filename)), of any length, lazily: it's a generator
+    of (valid, error) tuples as for verify_many, in input order.
+    The proofs are taken batch_size at a time, and each batch is checked
+    with verify_batch (parsing included) by a worker of pool, or of a pool
+    made as by make_pool for bitlength (so warm for the whole stream);
+    at most max_inflight batches (default twice the number of workers)
+    are in the pool at once, so that reading stays ahead of the workers
+    while memory stays bounded however many proofs there are.
+    cache is as for verify_many.
+    """
+    nworkers = workers or multiprocessing.cpu_count()
+    max_inflight = max_inflight or 2 * nworkers
+    own_pool = not pool
+    if own_pool:
+        pool = make_pool(nworkers, bitlength, 1, generator_file)
+    items = iter(proofs)
+    #(cache keys, which were cache hits, pending result) of each batch
+    inflight = deque()
+    def fill():
+        while len(inflight) < max_inflight:
+            batch = list(itertools.islice(items, batch_size))
+            if not batch:
+                return
+            keys = [cache.key(*item) if cache is not None else None for item in batch]
+            hits = [k is not None and cache.check(k) for k in keys]
+            todo = [item for item, hit in zip(batch, hits) if not hit]
+            inflight.append((keys, hits, pool.apply_async(_verify_task, (todo,))
+                             if todo else None))
+    try:
+        fill()
+        while inflight:
+            keys, hits, pending = inflight.popleft()
+            results = iter(pending.get() if pending else [])
+            fill()
+            for key, hit in zip(keys, hits):
+                if hit:
+                    yield (True, None)
+                    continue
+                result = next(results)
+                if key is not None and result[0]:
+                    cache.add(key)
+                yield result
+    finally:
+        if own_pool:
+            #if the caller stopped early there may still be batches running
+            if inflight:
+                pool.terminate()
+            else:
+                pool.close()
+            pool.join()
+
+def run_test_verify_stream(rangebits=8, count=40, filename="/tmp/bp-stream-test"):
+    from multiprocessing.pool import ThreadPool
+    made = prove_many(range(count // 2), rangebits, workers=2)
+    proofs = [(p, V, rangebits) for p, V, _, _ in made]
+    #the second half are invalid: each proof against the next one's V
+    proofs += [(p, proofs[(i + 1) % len(proofs)][1], b) for i, (p, V, b)
+               in enumerate(proofs)]
+    with open(filename, "w") as f:
+        f.write("# test proofs\n")
+        write_proofs(f, proofs)
+    expected = [(True, None)] * (count // 2) + [(False, None)] * (count // 2)
+    results = list(verify_stream(read_proofs(filename), workers=2, batch_size=3,
+                                 max_inflight=2, bitlength=rangebits))
+    assert results == expected, results
+    #a pool passed in, and lazily: the first result needs only the first batch
+    pool = ThreadPool(2)
+    stream = verify_stream(itertools.chain(proofs[:5], itertools.repeat(
+        ("junk", proofs[0][1], rangebits))), pool=pool, workers=2, batch_size=4)
+    assert [next(stream)[0] for _ in range(5)] == [True] * 5
+    valid, error = next(stream)
+    assert not valid and "length" in error, error
+    stream.close()
+    pool.close()
+    pool.join()
+    os.remove(filename)
+    print("Streaming verification test passed for", count, "proofs.")
+
+def run_test_tiered(rangebits=64):
+    import timeit
+    rp = RangeProof(rangebits)
+    rp.generate_proof(2**rangebits - 3)
+    proof, V = rp.get_proof_serialized(), rp.V
+    def tampered(offset, data):
+        return proof[:offset] + data + proof[offset + len(data):]
+    x = 1
+    while True:
+        try:
+            ECPoint.parse("\x02" + to_bytes(x))
+            x += 1
+        except ValueError:
+            break
+    other = RangeProof(rangebits)
+    other.generate_proof(1)
+    cases = [("valid", proof, V, True, 3, None),
+             ("truncated", proof[:-1], V, False, 1, REJECT_LENGTH),
+             ("bad prefix", tampered(0, "\x05"), V, False, 1, REJECT_POINT_ENCODING),
+             ("scalar >= N", tampered(132, "\xff" * 32), V, False, 1, REJECT_SCALAR_RANGE),
+             ("not on curve", tampered(1, to_bytes(x)), V, False, 1, REJECT_INVALID_POINT),
+             ("bad V", proof, "\x02" + to_bytes(x), False, 1, REJECT_COMMITMENT),
+             ("wrong V", proof, other.V, False, 2, REJECT_EQUATION_61),
+             ("changed t", tampered(196, to_bytes(rp.t ^ 1)), V, False, 2, REJECT_EQUATION_61),
+             ("changed a", tampered(228, to_bytes(from_bytes(proof[228:260]) ^ 1)), V,
+              False, 3, REJECT_VERIFICATION)]
+    for name, p, v, valid, stage, reason in cases:
+        start = timeit.default_timer()
+        result = verify_tiered(p, v, rangebits)
+        elapsed = timeit.default_timer() - start
+        assert (result.valid, result.stage, result.reason) == (valid, stage, reason), (
+            name, result)
+        assert bool(result) == valid
+        print("{:<14} stage {} {:<22} {:.6f}s".format(name, result.stage,
+                                                       result.reason, elapsed))
+    #without stage 2, (61) failures are only caught by the full check
+    result = verify_tiered(cases[7][1], V, rangebits, check61=False)
+    assert (result.valid, result.stage, result.reason) == (False, 3, REJECT_VERIFICATION)
+    assert verify_tiered(proof, [V], rangebits)
+    assert verify_tiered(proof, [V, V, V], rangebits).reason == REJECT_PARAMETERS
+    #too large, before any parsing
+    assert verify_tiered(proof, [V] * (2 * MAX_VALUES), rangebits).reason == REJECT_PARAMETERS
+    assert verify_tiered(proof, V, rangebits, max_bits=rangebits // 2).reason == (
+        REJECT_PARAMETERS)
+    for p in [proof.decode("latin-1"), None, 12345]:
+        result = verify_tiered(p, V, rangebits)
+        assert (result.valid, result.stage, result.reason) == (
+            False, 1, REJECT_PROOF_TYPE), result
+    #stage 3 reuses the challenges of stage 2: y and z, x, then u
+    calls = []
+    fiat_shamir = RangeProof.fiat_shamir
+    RangeProof.fiat_shamir = lambda self, *a, **k: calls.append(1) or fiat_shamir(
+        self, *a, **k)
+    try:
+        assert verify_tiered(proof, V, rangebits)
+    finally:
+        RangeProof.fiat_shamir = fiat_shamir
+    assert len(calls) == 3, calls
+    assert verify_tiered(proof, V, rangebits, last_stage=2).stage == 2
+    assert verify_tiered(cases[8][1], V, rangebits, last_stage=2)
+    assert not verify_tiered(cases[7][1], V, rangebits, last_stage=2)
+    print("Tiered verification tests passed.")
+
 def run_test_rangeproof(value, rangebits):
     print("Starting rangeproof test for value: ", value,
           " in range from 0 to 2^", rangebits)
@@ -275,7 +1053,19 @@ def run_test_rangeproof(value, rangebits):
         Varg = PC(encode(value, 256, minlen=32), blinding=rp.gamma).get_commitment()
     else:
         Varg = rp.V
-    if not rp2.verify(A, S, T1, T2, tau_x, mu, t, iproof, Varg):
+    result = rp2.verify(A, S, T1, T2, tau_x, mu, t, iproof, Varg)
+    if result != rp2.verify_stepwise(A, S, T1, T2, tau_x, mu, t, iproof, Varg):
+        print("Single multiexp and stepwise verification disagree; bug.")
+    #malformed proofs (here: truncated, a scalar out of range, a bad
+    #point prefix) must be rejected by the parser
+    for bad in [proof[:-1], proof[:132] + "\xff" * 32 + proof[164:],
+                "\x05" + proof[1:]]:
+        try:
+            rp2.deserialize_proof(bad)
+        except ValueError:
+            continue
+        print("Malformed proof was not rejected; bug.")
+    if not result:
         if not fail:
             print('Rangeproof should have verified but is invalid; bug.')
         else:
@@ -286,6 +1076,79 @@ def run_test_rangeproof(value, rangebits):
         else:
             print("Rangeproof succeeded but it should not have, value is not in range; bug.")
 
+def run_test_aggregated(values, rangebits):
+    print("Starting aggregated rangeproof test for values: ", values,
+          " in range from 0 to 2^", rangebits)
+    fail = not all([0 <= v < 2**rangebits for v in values])
+    if fail:
+        print("A value is NOT in range; we want verification to FAIL.")
+    #As in run_test_rangeproof, to attempt a forgery we prove the
+    #truncated values, and verify against commitments to the real ones.
+    proofvals = [v & (2**rangebits - 1) for v in values]
+    rp = RangeProof(rangebits, len(values))
+    rp.generate_proof(proofvals)
+    proof = rp.get_proof_serialized()
+    print("Got rangeproof: ", binascii.hexlify(proof))
+    print("Its length is: ", len(proof))
+    Vs = [PC(encode(v, 256, minlen=32), blinding=g).get_commitment() for v, g in zip(
+        values, rp.gamma)]
+    rp2 = RangeProof(rangebits, len(values))
+    A, S, T1, T2, tau_x, mu, t, iproof = rp2.deserialize_proof(proof)
+    result = rp2.verify(A, S, T1, T2, tau_x, mu, t, iproof, Vs)
+    if result != rp2.verify_stepwise(A, S, T1, T2, tau_x, mu, t, iproof, Vs):
+        print("Single multiexp and stepwise verification disagree; bug.")
+    if result == fail:
+        print("Aggregated rangeproof verification returned: ", result, "; bug.")
+    else:
+        print("Aggregated rangeproof verification returned: ", result,
+              " as expected.")
+
+def run_test_precomputed(rangebits=8, size=3):
+    import time
+    prover = PrecomputedProver(rangebits, size=size, workers=2)
+    #the fill threads make bundles until the queue is full
+    deadline = time.time() + 60
+    while not prover.queue.full() and time.time() < deadline:
+        time.sleep(0.05)
+    assert prover.queue.full()
+    #each proof takes the next bundle from the queue, and verifies
+    gammas = []
+    for v in [0, 5, 2**rangebits - 1]:
+        pre = prover.queue.queue[0]
+        rp = prover.prove(v)
+        assert pre.used and rp.gamma == pre.gammas[0]
+        gammas.append(rp.gamma)
+        assert _verify_batch([(rp.get_proof_serialized(), str(rp.V), rangebits)])[0] == [True]
+    #close doesn't wait for the queue to drain, or hang on a full one
+    start = time.time()
+    prover.close()
+    assert time.time() - start < 5, time.time() - start
+    #with the queue empty, prove makes the bundle itself
+    while not prover.queue.empty():
+        prover.queue.get_nowait()
+    rp = prover.prove(7)
+    gammas.append(rp.gamma)
+    assert _verify_batch([(rp.get_proof_serialized(), str(rp.V), rangebits)])[0] == [True]
+    #no bundle (so no blinding) was used twice
+    assert len(set(gammas)) == len(gammas)
+    print("Precomputed prover test passed.")
+
 if __name__ == "__main__":
+    #python rangeproof.py value rangebits [value2 value3 ...]
+    #with more than one value, an aggregated proof is tested.
+    #python rangeproof.py --stream tests verify_stream, --tiered verify_tiered,
+    #--precomputed PrecomputedProver.
+    if sys.argv[1:2] == ["--stream"]:
+        run_test_verify_stream()
+        sys.exit(0)
+    if sys.argv[1:2] == ["--precomputed"]:
+        run_test_precomputed()
+        sys.exit(0)
+    if sys.argv[1:2] == ["--tiered"]:
+        run_test_tiered()
+        sys.exit(0)
     value, rangebits = [int(x) for x in sys.argv[1:3]]
-    run_test_rangeproof(value, rangebits)
+    if len(sys.argv) > 3:
+        run_test_aggregated([value] + [int(x) for x in sys.argv[3:]], rangebits)
+    else:
+        run_test_rangeproof(value, rangebits)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+from __future__ import print_function
+"""Arithmetic in Z_N, the scalar field of secp256k1 (N being the group
+order): modular inversion, batch inversion, and fast conversion of
+integers to and from their 32 byte big endian serialization (also
+used for field elements, i.e. point coordinates).
+"""
+import binascii
+
+from jmbitcoin import N
+
+def inv(a, m=N):
+    """Returns the inverse of a modulo m, by the (iterative) extended
+    Euclidean algorithm; raises ValueError if there is none.
+    """
+    a %= m
+    x0, x1, r0, r1 = 0, 1, m, a
+    while r1:
+        q = r0 // r1
+        r0, r1 = r1, r0 - q * r1
+        x0, x1 = x1, x0 - q * x1
+    if r0 != 1:
+        raise ValueError("modular inverse does not exist")
+    return x0 % m
+
+def batch_inv(values, m=N):
+    """Returns the list of inverses modulo m of values, using a single
+    inversion and 3(k-1) multiplications for k values (Montgomery's trick):
+    with prefix products p_i = v_0...v_i, invert p_(k-1), then walk back,
+    v_i^-1 = p_(i-1) * p_i^-1 and p_(i-1)^-1 = v_i * p_i^-1.
+    Raises ValueError if any value is not invertible.
+    """
+    if not values:
+        return []
+    prefix = [values[0] % m]
+    for v in values[1:]:
+        prefix.append((prefix[-1] * v) % m)
+    acc = inv(prefix[-1], m)
+    inverses = [0] * len(values)
+    for i in range(len(values) - 1, 0, -1):
+        inverses[i] = (acc * prefix[i - 1]) % m
+        acc = (acc * values[i]) % m
+    inverses[0] = acc
+    return inverses
+
+def to_bytes(x, length=32):
+    """Big endian serialization of the non-negative integer x, zero-padded
+    to length bytes (as jmbitcoin's encode(x, 256, length)).
+    """
+    assert x >= 0
+    h = "%0*x" % (2 * length, x)
+    return binascii.unhexlify("0" + h if len(h) % 2 else h)
+
+def from_bytes(b):
+    """The integer whose big endian serialization is b (as
+    jmbitcoin's decode(b, 256)).
+    """
+    return int(binascii.hexlify(b), 16) if b else 0
+
+def run_test_scalar():
+    import os
+    from jmbitcoin import encode, decode
+    values = [from_bytes(os.urandom(32)) % N for _ in range(20)] + [1, N - 1]
+    for v, vinv in zip(values, batch_inv(values)):
+        assert (v * vinv) % N == 1 and vinv == inv(v)
+        assert to_bytes(v) == encode(v, 256, 32)
+        assert from_bytes(to_bytes(v)) == v == decode(encode(v, 256, 32), 256)
+    assert to_bytes(0) == "\x00" * 32 and from_bytes("") == 0
+    assert to_bytes(2**40, 4) == encode(2**40, 256, 4) and inv(3, 7) == 5
+    for bad in ([0], values + [N]):
+        try:
+            batch_inv(bad)
+        except ValueError:
+            continue
+        assert False, "zero was inverted"
+    print("Scalar tests passed.")
+
+if __name__ == "__main__":
+    run_test_scalar()
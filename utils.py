@@ -4,23 +4,17 @@ from __future__ import print_function
 bulletproof calculations; also ECC NUMS generators
 using the jmbitcoin bitcoin/secp256k1 library.
 """
+import os
+import mmap
 import hashlib
-from jmbitcoin import (getG, encode, decode, N, multiply, add_pubkeys,
-                       podle_PublicKey)
-
-def egcd(a, b):
-    if a == 0:
-        return (b, 0, 1)
-    else:
-        g, y, x = egcd(b % a, a)
-        return (g, x - (b // a) * y, y)
+from jmbitcoin import (getG, encode, N, podle_PublicKey)
+from ecpoint import ECPoint, batch_normalize
+from scalar import inv, from_bytes, to_bytes
+import ecbackend
 
 def modinv(a, m):
-    g, x, y = egcd(a, m)
-    if g != 1:
-        raise Exception('modular inverse does not exist')
-    else:
-        return x % m
+    #see scalar.inv
+    return inv(a, m)
 
 def inner_product(a, b, vtype="bin"):
     assert len(a) == len(b)
@@ -29,34 +23,316 @@ def inner_product(a, b, vtype="bin"):
     c = 0
     for i in range(len(a)):
         if vtype == "bin":
-            c += decode(a[i], 256) * decode(b[i], 256)
+            c += from_bytes(a[i]) * from_bytes(b[i])
         else:
             c += a[i] * b[i]
         c = c % N
     if vtype == "bin":
-        c = encode(c, 256, 32)
+        c = to_bytes(c)
     return c
 
 def halves(vec):
     assert len(vec) % 2 == 0
     return (vec[:len(vec)/2], vec[len(vec)/2:])
 
-#wrapper code for ECC operations
-def ecmult(scalar, point, usehex, rawpub=True, return_serialized=True):
-    if isinstance(scalar, (int, long)):
-        scalar = encode(scalar, 256, minlen=32)
-    if decode(scalar, 256) == 0:
-        return None
-    return multiply(scalar, point, usehex, rawpub=rawpub,
-                    return_serialized=return_serialized)
-
-def ecadd_pubkeys(pubkeys, usehex):
-    pubkeys = filter(None, pubkeys)
-    if len(pubkeys) == 1:
-        return pubkeys[0]
-    return add_pubkeys(pubkeys, usehex)
+#wrapper code for ECC operations. Points are passed around as ECPoint
+#objects (Jacobian coordinates); serialized points are also accepted as
+#input, and parsed on the way in (see to_point).
+def to_point(point):
+    """Returns point as an ECPoint; serializations of G and of NUMS
+    generators already in use are looked up rather than parsed again.
+    """
+    if isinstance(point, ECPoint):
+        return point
+    if point in _known_points:
+        return _known_points[point]
+    return ECPoint.parse(point)
 
-def getNUMS(index=0):
+def ecmult(scalar, point, usehex=False):
+    """Returns scalar * point as an ECPoint (the point at infinity
+    if the scalar is zero). The scalar may be an integer or a 32 byte
+    binary string; usehex is unused.
+    """
+    if not isinstance(scalar, (int, long)):
+        scalar = from_bytes(scalar)
+    backend = ecbackend.current or ecbackend.get_backend()
+    P = to_point(point)
+    if backend.native or P.table:
+        return P.mult(scalar % N)
+    return backend.to_ecpoint(backend.mult(scalar % N, backend.from_ecpoints([P])[0]))
+
+def ecmult2(a, P, b, Q):
+    """Returns a * P + b * Q as an ECPoint (a and b integers), with the
+    doublings shared (Shamir's trick): a table of i * P + j * Q for
+    i, j in 0..3, then one pass over both scalars two bits at a time.
+    For the inner product folds, where a 2-term multiexp would build and
+    normalize a table for each point only to use it once.
+    """
+    a, b = a % N, b % N
+    P, Q = to_point(P), to_point(Q)
+    backend = ecbackend.current or ecbackend.get_backend()
+    if not backend.native or P.table or Q.table:
+        return multiexp([a, b], [P, Q])
+    Ps = [ECPoint(), P, P.double()]
+    Ps.append(Ps[2].add(P))
+    Qs = [ECPoint(), Q, Q.double()]
+    Qs.append(Qs[2].add(Q))
+    #table[4 * i + j] = i * P + j * Q
+    table = [Pi.add(Qj) for Pi in Ps for Qj in Qs]
+    batch_normalize(table)
+    acc = ECPoint()
+    for j in reversed(range((max(a, b).bit_length() + 1) // 2)):
+        acc = acc.double().double()
+        d = 4 * ((a >> (2 * j)) & 3) + ((b >> (2 * j)) & 3)
+        if d:
+            acc = acc.add(table[d])
+    return acc
+
+def ecadd_pubkeys(pubkeys, usehex=False):
+    """Returns the sum of the points as an ECPoint; None entries
+    are skipped. usehex is unused.
+    """
+    acc = ECPoint()
+    for P in pubkeys:
+        if P is not None:
+            acc = acc.add(to_point(P))
+    return acc
+
+#Multi-scalar multiplication: sum_i s_i * P_i as one operation.
+#Up to this many (nonzero) terms, the products are just computed
+#directly.
+MSM_DIRECT_MAX_TERMS = 1
+#Below this many terms we use Straus, otherwise Pippenger.
+STRAUS_MAX_TERMS = 64
+
+def msm_window(nterms):
+    """Window size in bits for a multiexponentiation of nterms terms.
+    For Straus each point costs a table of 2^w - 1 multiples, for
+    Pippenger each window costs about 2^(w+1) bucket additions
+    against nterms point additions, which balances near log2(n) - 2.
+    """
+    if nterms < STRAUS_MAX_TERMS:
+        return 3 if nterms < 16 else 4
+    return max(4, min(16, nterms.bit_length() - 2))
+
+def _msm_digits(k, w, nwindows):
+    mask = (1 << w) - 1
+    return [(k >> (w * j)) & mask for j in range(nwindows)]
+
+def _msm_straus(scalars, points, w):
+    nwindows = (max(scalars).bit_length() + w - 1) // w
+    #tables[i][d-1] = d * points[i]; normalized all together, so that
+    #all the additions in the main loop are mixed additions.
+    tables = []
+    for P in points:
+        t = [P]
+        for d in range(2, 1 << w):
+            t.append(t[-1].add(P))
+        tables.append(t)
+    batch_normalize(sum(tables, []))
+    digits = [_msm_digits(k, w, nwindows) for k in scalars]
+    acc = ECPoint()
+    for j in reversed(range(nwindows)):
+        for _ in range(w):
+            acc = acc.double()
+        for i, d in enumerate(digits):
+            if d[j]:
+                acc = acc.add(tables[i][d[j] - 1])
+    return acc
+
+def _msm_pippenger(scalars, points, w):
+    nwindows = (max(scalars).bit_length() + w - 1) // w
+    mask = (1 << w) - 1
+    acc = ECPoint()
+    for j in reversed(range(nwindows)):
+        for _ in range(w):
+            acc = acc.double()
+        buckets = [ECPoint() for _ in range(1 << w)]
+        shift = w * j
+        for k, P in zip(scalars, points):
+            d = (k >> shift) & mask
+            if d:
+                buckets[d] = buckets[d].add(P)
+        #sum_d d * B_d as a running sum from the top bucket down
+        running = ECPoint()
+        total = ECPoint()
+        for d in reversed(range(1, 1 << w)):
+            running = running.add(buckets[d])
+            total = total.add(running)
+        acc = acc.add(total)
+    return acc
+
+def multiexp(scalars, points):
+    """Returns sum_i scalars[i] * points[i] as an ECPoint.
+    Scalars may be integers or 32 byte binary strings; points may be
+    ECPoints or serializations. Straus is used for few terms and
+    Pippenger's bucket method for many, see msm_window. Terms with a
+    fixed base (G, H) are taken from their precomputed tables instead.
+    With another EC backend selected (see ecbackend.py), the terms
+    without a table are passed to it.
+    """
+    backend = ecbackend.current or ecbackend.get_backend()
+    if backend.native:
+        return multiexp_native(scalars, points)
+    acc = ECPoint()
+    ks, Ps = [], []
+    for s, P in zip(scalars, points):
+        if not isinstance(s, (int, long)):
+            s = from_bytes(s)
+        s = s % N
+        if s and P is not None:
+            P = to_point(P)
+            if P.table:
+                acc = acc.add(P.table.mult(s))
+            elif not P.is_infinity():
+                ks.append(s)
+                Ps.append(P)
+    if not ks:
+        return acc
+    return acc.add(backend.to_ecpoint(backend.msm(ks, backend.from_ecpoints(Ps))))
+
+def multiexp_native(scalars, points):
+    """multiexp in pure Python, whichever backend is selected.
+    """
+    assert len(scalars) == len(points)
+    terms = []
+    acc = ECPoint()
+    for s, P in zip(scalars, points):
+        if not isinstance(s, (int, long)):
+            s = from_bytes(s)
+        s = s % N
+        if s and P is not None:
+            P = to_point(P)
+            if P.table:
+                acc = acc.add(P.table.mult(s))
+            elif not P.is_infinity():
+                terms.append((s, P))
+    return acc.add(_multiexp(terms))
+
+def _multiexp(terms):
+    if not terms:
+        return ECPoint()
+    if len(terms) <= MSM_DIRECT_MAX_TERMS:
+        return ecadd_pubkeys([P.mult(s) for s, P in terms])
+    ks, Ps = zip(*terms)
+    w = msm_window(len(terms))
+    if len(terms) < STRAUS_MAX_TERMS:
+        return _msm_straus(ks, Ps, w)
+    return _msm_pippenger(ks, Ps, w)
+
+def multiexp_is_zero(scalars, points):
+    """Returns True if sum_i scalars[i] * points[i] is the point
+    at infinity; False also if any serialized point is invalid.
+    """
+    try:
+        return multiexp(scalars, points).is_infinity()
+    except ValueError:
+        return False
+
+class FixedBaseTable(object):
+    """Precomputed multiples of a fixed base point B, for a window
+    size of w bits: row j holds d * 2^(wj) * B for d = 1 .. 2^w - 1.
+    k * B is then the sum of one entry for each nonzero w-bit digit of
+    k, so at most 256/w (mixed) point additions, with no doublings.
+    The rows are built on first use.
+    """
+    def __init__(self, point, w=4):
+        self.point = point
+        self.w = w
+        self.nwindows = (N.bit_length() + w - 1) // w
+        self.table = None
+        #(w, buffer, offset) of a table's affine points in a generator
+        #file, see NUMSRegistry; if w matches, read instead of computed
+        self.source = None
+
+    def build(self):
+        #built aside and then set, so that other threads never see
+        #a partial table
+        table = []
+        if self.source and self.source[0] == self.w:
+            _, buf, offset = self.source
+            rowlen = (1 << self.w) - 1
+            for j in range(self.nwindows):
+                table.append(read_affine_points(buf, offset + 64 * rowlen * j, rowlen))
+            self.table = table
+            return
+        base = self.point.copy()
+        for j in range(self.nwindows):
+            row = [base]
+            for d in range(2, 1 << self.w):
+                row.append(row[-1].add(base))
+            #2^w * base is the base of the next row
+            base = row[-1].add(base)
+            batch_normalize(row + [base])
+            table.append(row)
+        self.table = table
+
+    def mult(self, k):
+        k = k % N
+        if not self.table:
+            self.build()
+        mask = (1 << self.w) - 1
+        acc = ECPoint()
+        for j in range(self.nwindows):
+            d = (k >> (self.w * j)) & mask
+            if d:
+                acc = acc.add(self.table[j][d - 1])
+        return acc
+
+    def serialize(self):
+        """The table's points, affine (x, y), 64 bytes each, row by row.
+        """
+        if not self.table:
+            self.build()
+        return "".join([P.serialize(False)[1:] for row in self.table for P in row])
+
+def sha256_range(buf, start, end, chunk=1 << 20):
+    """sha256 digest of buf[start:end], hashed in chunks so that a large
+    mapped file is never copied whole.
+    """
+    h = hashlib.sha256()
+    for i in range(start, end, chunk):
+        h.update(buf[i:min(i + chunk, end)])
+    return h.digest()
+
+def read_affine_points(buf, offset, count):
+    """The count points stored as 64 byte affine (x, y) at offset in buf,
+    as ECPoints; not checked to be on the curve.
+    """
+    return [ECPoint(from_bytes(buf[o:o + 32]), from_bytes(buf[o + 32:o + 64]), 1)
+            for o in range(offset, offset + 64 * count, 64)]
+
+#serializations of G and of NUMS generators in use -> ECPoint
+_known_points = {}
+_G = None
+
+def getG_point():
+    """secp256k1's G as an ECPoint, with a fixed-base table.
+    """
+    global _G
+    if _G is None:
+        _G = ECPoint.parse(getG(True))
+        _G.table = FixedBaseTable(_G)
+        _G.table.source = nums_registry.tables.get(G_TABLE_ID)
+        _known_points[getG(True)] = _G
+    return _G
+
+#NUMS indices of points used as fixed bases, which get a FixedBaseTable:
+#255 is H, the blinding base point of PC.
+FIXED_BASE_NUMS = [255]
+#stands for G among the indices of fixed bases in a generator file
+G_TABLE_ID = 2**32 - 1
+
+def nums_index(i):
+    """Maps the i-th (counting from 0) entry of the concatenated
+    generator vectors G*, H* to the index passed to getNUMS.
+    Index 0 is reserved for the default U of VPC and 255 for the
+    blinding base point H of PC, so we count from 1 and step over 255;
+    for all vector lengths up to 2*127 this is the same as i+1.
+    """
+    return i + 1 if i < 254 else i + 2
+
+def derive_NUMS(index=0):
     """Taking secp256k1's G as a seed,
     either in compressed or uncompressed form,
     append "index" as a byte, and append a second byte "counter"
@@ -65,18 +341,23 @@ def getNUMS(index=0):
     until finding a valid curve point. The first such point is
     considered as "the" NUMS base point alternative for this index value.
 
+    Indices of 256 and above are appended as their minimal big-endian
+    encoding (so 2 or more bytes) instead of a single byte; since the
+    seed length then differs, these can never collide with the single
+    byte case, and values for indices below 256 are unchanged.
+
     The search process is of course deterministic/repeatable, so
     it's fine to just store a list of all the correct values for
     each index, but for transparency left in code for initialization
-    by any user.
+    by any user. See NUMSRegistry for the cached/stored version.
     
     The NUMS generator generated is returned as a secp256k1.PublicKey.
     """
-
-    assert index in range(256)
+    assert isinstance(index, (int, long)) and index >= 0
+    index_bytes = chr(index) if index < 256 else encode(index, 256)
     nums_point = None
     for G in [getG(True), getG(False)]:
-        seed = G + chr(index)
+        seed = G + index_bytes
         for counter in range(256):
             seed_c = seed + chr(counter)
             hashed_seed = hashlib.sha256(seed_c).digest()
@@ -91,12 +372,226 @@ def getNUMS(index=0):
                 continue
     assert False, "It seems inconceivable, doesn't it?"
 
+class NUMSRegistry(object):
+    """Holds the NUMS generators derived by derive_NUMS, so that each
+    one is only searched for once per process. The table can be written
+    to and read from a file, so that a new process (e.g. a pool worker)
+    can start with all the generators it needs without redoing the
+    sha256 search.
+
+    File format (version 1):
+    magic "BPNUMS" | version (1 byte) | count (4 bytes, big-endian) |
+    sha256 of the body (32 bytes) | body
+    where the body is the 33 byte compressed serializations of the
+    generators for index 0 .. count-1, concatenated.
+
+    File format (version 2, the default for save):
+    magic "BPNUMS" | version (1 byte) | count (4 bytes) | w (1 byte) |
+    number of tables (1 byte) | sha256 of the body (32 bytes) | body
+    where the body is the generators for index 0 .. count-1 as 64 byte
+    affine (x, y), then for each fixed base (G and FIXED_BASE_NUMS) its
+    index (4 bytes, G_TABLE_ID for G) and its FixedBaseTable for window
+    w, as FixedBaseTable.serialize. A version 2 file is memory-mapped
+    (read-only), and points are only read from it when used: loading
+    needs no square roots and no table building, and all the processes
+    using the file share the one copy in the page cache.
+    """
+    magic = "BPNUMS"
+    version = 2
+
+    def __init__(self):
+        #index -> 33 byte serialization; index -> PublicKey object;
+        #index -> ECPoint. The last two are filled lazily, so a loaded
+        #table costs nothing until a generator is actually used.
+        self.serialized = {}
+        self.points = {}
+        self.ecpoints = {}
+        #from a version 2 file: index -> (buffer, offset) of the affine
+        #point, and fixed base index -> (w, buffer, offset) of its table
+        self.affine = {}
+        self.tables = {}
+
+    def get(self, index):
+        if index not in self.points:
+            if index in self.serialized:
+                self.points[index] = podle_PublicKey(self.serialized[index])
+            else:
+                point = derive_NUMS(index)
+                #serialized first: get_serialized relies on it once
+                #the point is there
+                self.serialized[index] = point.serialize()
+                self.points[index] = point
+        return self.points[index]
+
+    def get_serialized(self, index):
+        if index not in self.serialized:
+            self.get(index)
+        return self.serialized[index]
+
+    def get_point(self, index):
+        if index not in self.ecpoints:
+            ser = self.get_serialized(index)
+            if index in self.affine:
+                P = read_affine_points(self.affine[index][0], self.affine[index][1], 1)[0]
+            else:
+                P = ECPoint.parse(ser)
+            if index in FIXED_BASE_NUMS:
+                P.table = FixedBaseTable(P)
+                P.table.source = self.tables.get(index)
+            self.ecpoints[index] = P
+            _known_points[ser] = P
+        return self.ecpoints[index]
+
+    def save(self, filename, count=None, version=2):
+        """Writes generators 0 .. count-1 to filename (deriving any
+        not yet known), and for version 2 the fixed-base tables
+        (building them if need be); count defaults to covering all
+        currently held indices.
+        """
+        if count is None:
+            count = max(self.serialized.keys()) + 1 if self.serialized else 0
+        if version == 1:
+            body = "".join([self.get_serialized(i) for i in range(count)])
+            header = self.magic + chr(1) + to_bytes(count, 4)
+        else:
+            bases = [(G_TABLE_ID, getG_point())] + [
+                (i, self.get_point(i)) for i in FIXED_BASE_NUMS]
+            w = bases[0][1].table.w
+            assert all([P.table.w == w for _, P in bases])
+            body = "".join([self.get_point(i).serialize(False)[1:] for i in range(count)] +
+                           [to_bytes(i, 4) + P.table.serialize() for i, P in bases])
+            header = self.magic + chr(2) + to_bytes(count, 4) + chr(w) + chr(len(bases))
+        with open(filename, "wb") as f:
+            f.write(header + hashlib.sha256(body).digest() + body)
+
+    def load(self, filename, verify=False):
+        """Reads a table written by save(). The checksum detects corruption,
+        it does not authenticate the file: anyone can write a file with a
+        valid checksum, and the points are used as read (read_affine_points
+        does not check they are on the curve), so a tampered file silently
+        gives wrong generators. If the file is not from a trusted source,
+        pass verify=True to re-derive and compare every entry (which
+        is exactly the cost the file is intended to save; the points and
+        tables are then not taken from the file, only checked against).
+        Returns the number of generators loaded.
+        """
+        with open(filename, "rb") as f:
+            if os.fstat(f.fileno()).st_size <= len(self.magic):
+                raise ValueError("Not a NUMS generator file: " + filename)
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        #the mapping is kept open only if points or tables are used from it
+        try:
+            if data[:len(self.magic)] != self.magic:
+                raise ValueError("Not a NUMS generator file: " + filename)
+            ver = ord(data[len(self.magic)])
+            if ver == 1:
+                count = self._load_v1(filename, data, verify)
+                data.close()
+                return count
+            if ver != 2:
+                raise ValueError("Unsupported NUMS generator file version: " + str(ver))
+            hlen = len(self.magic) + 1 + 4 + 1 + 1 + 32
+            if len(data) < hlen:
+                raise ValueError("Corrupted NUMS generator file: " + filename)
+            count = from_bytes(data[len(self.magic) + 1:len(self.magic) + 5])
+            w, ntables = ord(data[hlen - 34]), ord(data[hlen - 33])
+            #also bounds tsize, before it is computed
+            if not 1 <= w <= 16:
+                raise ValueError("Corrupted NUMS generator file (window size): " + filename)
+            tsize = 4 + 64 * ((N.bit_length() + w - 1) // w) * ((1 << w) - 1)
+            if len(data) != hlen + 64 * count + tsize * ntables or sha256_range(
+                data, hlen, len(data)) != data[hlen - 32:hlen]:
+                raise ValueError("Corrupted NUMS generator file: " + filename)
+            for i in range(count):
+                offset = hlen + 64 * i
+                #compressed: the parity of y, and x
+                ser = chr(2 + (ord(data[offset + 63]) & 1)) + data[offset:offset + 32]
+                self._add_serialized(i, ser, verify)
+            tables = {}
+            for t in range(ntables):
+                offset = hlen + 64 * count + tsize * t
+                tables[from_bytes(data[offset:offset + 4])] = (w, data, offset + 4)
+            if verify:
+                for i, P in [(G_TABLE_ID, getG_point())] + [
+                    (i, self.get_point(i)) for i in FIXED_BASE_NUMS]:
+                    if i in tables and tables[i][0] == P.table.w and P.table.serialize(
+                        ) != data[tables[i][2]:tables[i][2] + tsize - 4]:
+                        raise ValueError("Invalid fixed-base table in file")
+                data.close()
+                return count
+        except ValueError:
+            data.close()
+            raise
+        for i in range(count):
+            self.affine[i] = (data, hlen + 64 * i)
+        self.tables.update(tables)
+        #tables of fixed bases already in use, but not yet built
+        for i, P in [(G_TABLE_ID, _G)] + [(i, self.ecpoints.get(i)) for i in FIXED_BASE_NUMS]:
+            if P is not None and P.table and not P.table.table:
+                P.table.source = self.tables.get(i)
+        return count
+
+    def _load_v1(self, filename, data, verify):
+        hlen = len(self.magic) + 1 + 4 + 32
+        if len(data) < hlen:
+            raise ValueError("Corrupted NUMS generator file: " + filename)
+        count = from_bytes(data[len(self.magic) + 1:len(self.magic) + 5])
+        if len(data) != hlen + 33 * count or sha256_range(
+            data, hlen, len(data)) != data[hlen - 32:hlen]:
+            raise ValueError("Corrupted NUMS generator file: " + filename)
+        for i in range(count):
+            offset = hlen + 33 * i
+            self._add_serialized(i, data[offset:offset + 33], verify)
+        return count
+
+    def _add_serialized(self, i, ser, verify):
+        if verify and derive_NUMS(i).serialize() != ser:
+            raise ValueError("Invalid NUMS generator in file at index " + str(i))
+        if self.serialized.get(i, ser) != ser:
+            raise ValueError("NUMS generator mismatch at index " + str(i))
+        self.serialized[i] = ser
+
+#The process-wide registry used by getNUMS
+nums_registry = NUMSRegistry()
+
+def getNUMS(index=0):
+    """Returns the NUMS generator for index (see derive_NUMS)
+    as a secp256k1.PublicKey, deriving it only on first use.
+    """
+    return nums_registry.get(index)
+
+def getNUMS_point(index=0):
+    """As getNUMS, but returns the generator as an ECPoint.
+    """
+    return nums_registry.get_point(index)
+
+def warm_generators(n):
+    """Derives and parses the generators G*, H* for vectors of length n,
+    and U, H and G, and builds the fixed-base tables of G and H, so that
+    the first proof made afterwards doesn't pay for any of it (e.g. in a
+    new pool worker).
+    """
+    for i in range(2 * n):
+        getNUMS_point(nums_index(i))
+    getNUMS_point(0)
+    for P in [getG_point(), getNUMS_point(255)]:
+        if not P.table.table:
+            P.table.build()
+
 class Vector(object):
     """A vector with elements in Zn; here n is set as 'size'
     in constructor. Optionally constructable from a value v, as integer,
     converted into a bitvector; this is triggered by setting the bitlength
     variable, which controls the length of the bitvector.
+    Wherever a vector argument is taken, a scalar (int) may be passed
+    instead, standing for the vector with all elements equal to it (so
+    a + z.1^n is just a.add(z)). The fused operations (hadamard_offset,
+    add_scaled) evaluate expressions like yn o (aR + z.1^n) + w in one
+    pass, without building the intermediate vectors, and inner_product
+    reduces only once, at the end.
     """
+    __slots__ = ("v", "size", "length", "bitstring")
+
     def __str__(self):
         return ",".join([str(x) for x in self.v])
 
@@ -105,52 +600,131 @@ class Vector(object):
         if bitlength:
             assert isinstance(v, (int, long))
             assert v >= 0
-            self.bitstring = bin(v)[2:]
-            self.v = [int(x) for x in self.bitstring]
-            if bitlength:
-                assert bitlength >= len(self.v)
-                self.v = [0]*(bitlength - len(self.v)) + self.v
-                self.bitstring = "0" * (bitlength - len(self.v)) + self.bitstring
-            self.v = self.v[::-1]
+            assert bitlength >= v.bit_length()
+            self.bitstring = bin(v)[2:].zfill(bitlength)
+            self.v = [(v >> i) & 1 for i in range(bitlength)]
         else:
             #Some sanity checking here would be appropriate.
             self.v = v
         self.length = len(self.v)
 
-    def subtract(self, v):
+    def _elements(self, v):
+        """The list of elements of v, which may be a Vector, a list,
+        or a scalar (repeated self.length times).
+        """
         if isinstance(v, Vector):
-            v = v.v
-        newv = [(self.v[x] - v[x]) % self.size for x in range(self.length)]
-        return Vector(newv, size=self.size)
+            return v.v
+        if isinstance(v, (int, long)):
+            return [v] * self.length
+        return v
+
+    def subtract(self, v):
+        m = self.size
+        if isinstance(v, (int, long)):
+            return Vector([(x - v) % m for x in self.v], size=m)
+        return Vector([(x - y) % m for x, y in zip(self.v, self._elements(v))],
+                      size=m)
 
     def add(self, v):
-        if isinstance(v, Vector):
-            v = v.v
-        newv = [(self.v[x] + v[x]) % self.size for x in range(self.length)]
-        return Vector(newv, size=self.size)
+        m = self.size
+        if isinstance(v, (int, long)):
+            return Vector([(x + v) % m for x in self.v], size=m)
+        return Vector([(x + y) % m for x, y in zip(self.v, self._elements(v))],
+                      size=m)
 
     def hadamard(self, v):
         #hadamard is the vector whose elements are the pairwise product of
         #the two input vectors
-        if isinstance(v, Vector):
-            v = v.v
-        newv = [(self.v[x] * v[x]) % self.size for x in range(self.length)]
-        return Vector(newv, size=self.size)
+        m = self.size
+        return Vector([(x * y) % m for x, y in zip(self.v, self._elements(v))],
+                      size=m)
+
+    def hadamard_offset(self, v, offset, add=0):
+        """Returns self o (v + offset) + add, offset and add being
+        vectors or scalars, as one pass over the elements.
+        """
+        m = self.size
+        if isinstance(add, (int, long)) and isinstance(offset, (int, long)):
+            return Vector([(x * (y + offset) + add) % m for x, y in zip(
+                self.v, self._elements(v))], size=m)
+        return Vector([(x * (y + o) + w) % m for x, y, o, w in zip(
+            self.v, self._elements(v), self._elements(offset),
+            self._elements(add))], size=m)
+
+    def add_scaled(self, v, k):
+        """Returns self + k.v, in one pass over the elements.
+        """
+        m = self.size
+        return Vector([(x + k * y) % m for x, y in zip(self.v, self._elements(v))],
+                      size=m)
 
     def scalar_mult(self, k):
-        newv = [(k * self.v[x]) % self.size for x in range(self.length)]
-        return Vector(newv, size=self.size)
+        m = self.size
+        return Vector([(k * x) % m for x in self.v], size=m)
 
     def inner_product(self, v):
-        if isinstance(v, Vector):
-            v = v.v
-        return sum([(v[x] * self.v[x]) % self.size for x in range(self.length)]) % self.size
+        #the elements are reduced, so the products can be summed
+        #before a single reduction
+        return sum([x * y for x, y in zip(self.v, self._elements(v))]) % self.size
 
 class PowerVector(Vector):
     """A vector constructed from powers of a scalar, e.g.
     v = y*^n = (y^0, y^1, ... , y^(n-1))
     """
+    __slots__ = ()
+
     def __init__(self, val, length, size=N):
         self.size = size
-        self.v = [pow(val, k, self.size) for k in range(length)]
-        self.length = len(self.v)
\ No newline at end of file
+        self.v = [1] * length
+        val %= size
+        for k in range(1, length):
+            self.v[k] = (self.v[k - 1] * val) % size
+        self.length = length
+
+def run_test_generator_file(n=16, filename="/tmp/bp-generators-test"):
+    import timeit
+    warm_generators(n)
+    for version in (1, 2):
+        nums_registry.save(filename, version=version)
+        reg = NUMSRegistry()
+        start = timeit.default_timer()
+        count = reg.load(filename)
+        for i in range(count):
+            assert reg.get_point(i) == nums_registry.get_point(i)
+            assert reg.get_serialized(i) == nums_registry.get_serialized(i)
+        elapsed = timeit.default_timer() - start
+        assert NUMSRegistry().load(filename, verify=True) == count
+        print("Version", version, "file:", os.path.getsize(filename), "bytes,",
+              count, "generators loaded in", "%.4f" % elapsed, "s")
+    H = reg.get_point(255)
+    assert H.table.source and reg.tables.get(G_TABLE_ID)
+    H.table.build()
+    assert [P.serialize() for P in sum(H.table.table, [])] == [
+        P.serialize() for P in sum(nums_registry.get_point(255).table.table, [])]
+    assert H.table.mult(12345) == nums_registry.get_point(255).mult(12345)
+    data = open(filename, "rb").read()
+    #a flipped bit, and window sizes (outside the checksum) of 0 and 255
+    wpos = len(NUMSRegistry.magic) + 5
+    for bad in [data[:-1] + chr(ord(data[-1]) ^ 1),
+                data[:wpos] + "\x00" + data[wpos + 1:],
+                data[:wpos] + "\xff" + data[wpos + 1:]]:
+        with open(filename, "wb") as f:
+            f.write(bad)
+        try:
+            NUMSRegistry().load(filename)
+            assert False, "corrupted generator file loaded"
+        except ValueError:
+            pass
+    os.remove(filename)
+    print("Generator file tests passed.")
+
+if __name__ == "__main__":
+    #python utils.py filename [n]: writes the generators for vectors of
+    #length n (default 64) and the fixed-base tables to filename (e.g. for
+    #make_pool's generator_file); python utils.py with no arguments tests.
+    import sys
+    if len(sys.argv) > 1:
+        warm_generators(int(sys.argv[2]) if len(sys.argv) > 2 else 64)
+        nums_registry.save(sys.argv[1])
+    else:
+        run_test_generator_file()
@@ -5,17 +5,19 @@ import hashlib
 import json
 import binascii
 
-from jmbitcoin import (getG, encode, decode, N, podle_PublicKey, podle_PrivateKey)
+from jmbitcoin import (encode, decode, N, podle_PublicKey, podle_PrivateKey)
 
-from utils import ecmult, ecadd_pubkeys, getNUMS
+from scalar import to_bytes, from_bytes
+from utils import (ecmult, ecadd_pubkeys, nums_index, multiexp,
+                   getNUMS_point, getG_point, to_point)
 
 class PC(object):
     """A simple pedersen commitment to a single scalar value
     """
     def __init__(self, v, g=None, h=None, blinding=None):
         self.v = v
-        self.g = getG(True) if not g else g
-        self.h = getNUMS(255).serialize() if not h else h
+        self.g = getG_point() if not g else g
+        self.h = getNUMS_point(255) if not h else h
         self.set_blinding(blinding)
         self.get_commitment()
 
@@ -23,11 +25,11 @@ class PC(object):
         self.blinding = blinding if blinding else os.urandom(32)
 
     def get_commitment(self):
-        self.C = ecmult(self.blinding, self.h, False)
-        self.C = ecadd_pubkeys([self.C, ecmult(self.v, self.g, False)], False)
+        self.C = multiexp([self.blinding, self.v], [self.h, self.g])
         return self.C
     def serialize(self):
-        return "\n".join([binascii.hexlify(x) for x in [self.v, self.g, self.blinding, self.h]])
+        return "\n".join([binascii.hexlify(str(x)) for x in [self.v, self.g,
+                                                             self.blinding, self.h]])
 
 class VPC(object):
     """An object to encapsulate a vector pedersen
@@ -51,8 +53,8 @@ class VPC(object):
         assert vtype in ["bin", "int"]
         if vtype == "int":
             #Convert to binary for EC operations
-            a = [encode(x%N, 256, 32) for x in a]
-            b = [encode(x%N, 256, 32) for x in b]
+            a = [to_bytes(x % N) for x in a]
+            b = [to_bytes(x % N) for x in b]
         self.a = a
         self.b = b
         #the blinding is not initialized; it
@@ -83,7 +85,7 @@ class VPC(object):
                 self.c = os.urandom(32)
         else:
             if isinstance(c, (int, long)):
-                c = encode(c, 256, minlen=32)
+                c = to_bytes(c)
             self.c = c
 
     def set_base_points(self, g=None, h=None, u=None):
@@ -93,19 +95,19 @@ class VPC(object):
         Acts as a pure setter for g* and h* vectors, for cases
         where we just use VPC as a commitment extractor directly.
         """
-        self.U = u if u else getNUMS(0).serialize()
+        self.U = u if u else getNUMS_point(0)
         if g:
             self.g = g
         else:
             self.g = []
             for i in range(self.vlen):
-                self.g.append(getNUMS(i+1).serialize())
+                self.g.append(getNUMS_point(nums_index(i)))
         if h:
             self.h = h
         else:
             self.h = []
             for j in range(self.vlen, 2*self.vlen):
-                self.h.append(getNUMS(j+1).serialize())
+                self.h.append(getNUMS_point(nums_index(j)))
 
     def get_commitment(self):
         """Returns:
@@ -113,11 +115,89 @@ class VPC(object):
         w_1 * H_1 + w_2 * H_2 + ... + w_n * H_n
         """
         self.set_blinding()
-        self.P = ecmult(self.c, self.U, False)
-        for i, x in enumerate(self.a):
-            self.P = ecadd_pubkeys([self.P, ecmult(x, self.g[i], False)], False)
-        for i, x in enumerate(self.b):
-            self.P = ecadd_pubkeys([self.P, ecmult(x, self.h[i], False)], False)
+        self.P = multiexp([self.c] + self.a + self.b,
+                          [self.U] + self.g + self.h)
+        return self.P
+
+    def update(self, a=None, b=None, c=None):
+        """Sets elements of a* and b*, given as dicts {index: new value},
+        and/or the blinding c (values as integers or 32 byte binary). If
+        the commitment P has been computed, it is updated to match by
+        adding (new - old) times the generator of each changed element,
+        as one multiexponentiation of only the changed terms, instead of
+        being recomputed from all 2n + 1. Returns P (None if not computed).
+        Indices are taken modulo n (so -1 is the last); an index given
+        twice for the same vector is an error. Everything is computed
+        before anything is changed, so if this raises, nothing is.
+        """
+        new_a, new_b, scalars, points = self._element_updates(a, b)
+        if c is not None:
+            c = to_bytes(c % N) if isinstance(c, (int, long)) else c
+            if self.c is not None:
+                scalars.append(from_bytes(c) - from_bytes(self.c))
+                points.append(self.U)
+        P = self._apply_updates(new_a, new_b, scalars, points)
+        if c is not None:
+            self.c = c
+        return P
+
+    def set_a(self, i, value):
+        return self.update(a={i: value})
+
+    def set_b(self, i, value):
+        return self.update(b={i: value})
+
+    def set_c(self, value):
+        return self.update(c=value)
+
+    def _element_updates(self, a, b):
+        """Checks the changes to a* and b*, without making them; returns
+        the new elements of each ({index: value}, indices modulo n) and
+        the (scalars, points) of the (new - old) * generator terms.
+        """
+        new, scalars, points = [], [], []
+        for v, gens, changes in [(self.a, self.g, a), (self.b, self.h, b)]:
+            updates = {}
+            for i, value in (changes or {}).items():
+                if not isinstance(i, (int, long)) or not -self.vlen <= i < self.vlen:
+                    raise IndexError("Invalid vector index: " + repr(i))
+                i %= self.vlen
+                if i in updates:
+                    raise ValueError("Vector index updated twice: " + str(i))
+                updates[i] = to_bytes(value % N) if isinstance(value, (int, long)) else value
+                scalars.append(from_bytes(updates[i]) - from_bytes(v[i]))
+                points.append(gens[i])
+            new.append(updates)
+        return (new[0], new[1], scalars, points)
+
+    def _apply_updates(self, new_a, new_b, scalars, points):
+        """Sets the new elements and P (if computed) plus the terms; the
+        new P is computed first, so that if that fails nothing is set.
+        """
+        P = getattr(self, "P", None)
+        if P is not None and scalars:
+            P = to_point(P).add(multiexp([x % N for x in scalars], points))
+        for v, updates in [(self.a, new_a), (self.b, new_b)]:
+            for i, value in updates.items():
+                v[i] = value
+        if P is not None:
+            self.P = P
+        return P
+
+    def get_bit_commitment(self, cU=None):
+        """For a* a vector of bits and b* = a* - 1^n (as for the commitment
+        A in the rangeproof), returns the same as get_commitment, but built
+        as a sum of G_i (where a_i = 1) and -H_i (where a_i = 0), so that
+        the only scalar multiplication is the blinding term c * U (which
+        can be passed in as cU, if already known).
+        """
+        self.set_blinding()
+        P = cU if cU else ecmult(self.c, self.U)
+        for a, b, g, h in zip(self.a, self.b, self.g, self.h):
+            bit = from_bytes(a)
+            assert bit in (0, 1) and from_bytes(b) == (bit - 1) % N
+            P = P.add(to_point(g) if bit else to_point(h).neg())
+        self.P = P
         return self.P
 
 
@@ -136,12 +216,12 @@ def run_test_VPC():
     vpc = VPC(v, v, vtype="int")
     print("Successfully created the pedersen commitment to: ", rawv)
     C = vpc.get_commitment()
-    print("Here is the commitment: ", binascii.hexlify(C))
+    print("Here is the commitment: ", binascii.hexlify(str(C)))
     rawv2 = raw_input("Test homomorphism: enter second vector: ")
     v2 = [int(x) for x in rawv2.split(',')]
     vpc2 = VPC(v2, v2, vtype="int")
     C2 = vpc2.get_commitment()
-    print("Here is the commitment for the second vector: ", binascii.hexlify(C2))
+    print("Here is the commitment for the second vector: ", binascii.hexlify(str(C2)))
     assert len(v2) == len(v), "try again"
     sumv = [x + y for x, y in zip(v, v2)]
     print('here is sumv: ', sumv)
@@ -151,8 +231,8 @@ def run_test_VPC():
     #reset the blinding value
     sumvpc.set_blinding(c=newc)
     Csum = sumvpc.get_commitment()
-    print("Here is the commitment to the sum: ", binascii.hexlify(Csum))
-    print("Here is the sum of C and C2: ", binascii.hexlify(ecadd_pubkeys([C, C2], False)))
+    print("Here is the commitment to the sum: ", binascii.hexlify(str(Csum)))
+    print("Here is the sum of C and C2: ", binascii.hexlify(str(ecadd_pubkeys([C, C2], False))))
     if Csum == ecadd_pubkeys([C, C2], False):
         print("Successly verified homomorphism")
     else:
@@ -166,5 +246,66 @@ def run_test_VPC():
     if not verify_opening(Csum, sumvpc.c, sumv, sumv, vtype="int"):
         print("Vsum did not verify")
 
+def run_test_updates(n=64):
+    import timeit
+    a = [from_bytes(os.urandom(32)) % N for _ in range(n)]
+    b = [from_bytes(os.urandom(32)) % N for _ in range(n)]
+    vpc = VPC(list(a), list(b), vtype="int")
+    vpc.get_commitment()
+    start = timeit.default_timer()
+    vpc.set_a(3, 12345)
+    single = timeit.default_timer() - start
+    vpc.set_b(n - 1, to_bytes(7))
+    vpc.set_c(99)
+    vpc.update(a={0: 1, 5: 0}, b={1: N - 1})
+    a[3], a[0], a[5], b[n - 1], b[1] = 12345, 1, 0, 7, N - 1
+    fresh = VPC(a, b, vtype="int")
+    fresh.set_blinding(c=99)
+    start = timeit.default_timer()
+    assert vpc.P == fresh.get_commitment()
+    full = timeit.default_timer() - start
+    #indices are modulo n; aliases of one index, or a bad value, change nothing
+    vpc.set_a(-1, 5)
+    a[n - 1] = 5
+    fresh = VPC(a, b, vtype="int")
+    fresh.set_blinding(c=99)
+    assert vpc.a[n - 1] == to_bytes(5) and vpc.P == fresh.get_commitment()
+    state = (list(vpc.a), list(vpc.b), vpc.c, vpc.P)
+    for bad in [dict(a={-1: 6, n - 1: 7}), dict(a={n: 1}), dict(a={0: 8}, b={0: 1.5})]:
+        try:
+            vpc.update(**bad)
+        except (IndexError, ValueError, TypeError):
+            pass
+        else:
+            assert False, bad
+        assert (vpc.a, vpc.b, vpc.c, vpc.P) == state, bad
+    #the inner product commitment keeps its c = <a, b> up to date
+    from innerproduct import IPC
+    ipc = IPC(list(a), list(b), vtype="int")
+    ipc.get_commitment()
+    ipc.update(a={2: 5, 7: 6}, b={2: 9})
+    ipc.set_b(8, 0)
+    ipc.update(a={-3: 4}, b={n - 3: 2})
+    a[2], a[7], b[2], b[8], a[n - 3], b[n - 3] = 5, 6, 9, 0, 4, 2
+    fresh = IPC(a, b, vtype="int")
+    assert ipc.c == fresh.c == to_bytes(sum([x * y for x, y in zip(a, b)]) % N)
+    assert ipc.P == fresh.get_commitment()
+    #proving, updating and proving again gives two valid proofs
+    proofs = [ipc.generate_proof()]
+    commitments = [ipc.P]
+    ipc.update(a={0: 2})
+    proofs.append(ipc.generate_proof())
+    commitments.append(ipc.P)
+    for (pa, pb, L, R), P in zip(proofs, commitments):
+        assert len(L) == len(R) == n.bit_length() - 1
+        assert IPC(["\x01"] * n, ["\x02"] * n).verify_proof(pa, pb, P, L, R)
+    print("Commitment update tests passed; one element update: %.6fs, "
+          "full recomputation: %.6fs" % (single, full))
+
 if __name__ == "__main__":
-    run_test_VPC()
\ No newline at end of file
+    #python vectorpedersen.py --updates tests the incremental updates
+    import sys
+    if sys.argv[1:2] == ["--updates"]:
+        run_test_updates()
+    else:
+        run_test_VPC()
\ No newline at end of file
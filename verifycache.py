@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+from __future__ import print_function
+"""A cache of proofs already verified, so that seeing the same proof
+again (relayed, then in a block, then after a reorg) costs a hash
+rather than the EC work. Entries are keyed by a sha256 digest of the
+proof, its commitment(s) V and bitlength; only valid proofs are added,
+so the cache can never make an invalid proof pass (short of a sha256
+collision), and a proof rejected once is just checked again.
+Pass a VerificationCache as cache= to rangeproof.verify_batch,
+verify_many or verifyserver.VerificationService.
+"""
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+from scalar import to_bytes, from_bytes
+
+class VerificationCache(object):
+    """A bounded (least recently used entries evicted first) set of the
+    keys of verified proofs, safe to share between threads. If filename
+    is given, the cache is loaded from it if it exists, and save() writes
+    it back. hits and misses count the lookups (check) made.
+    """
+    magic = "BPVCACHE"
+    version = 1
+
+    def __init__(self, maxsize=100000, filename=None):
+        self.maxsize = maxsize
+        self.filename = filename
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if filename and os.path.exists(filename):
+            self.load(filename)
+
+    @staticmethod
+    def key(proof, V, bitlength):
+        """The digest of a (serialized proof, V, bitlength) as given to
+        verify_batch; V is a point or a list of points for an aggregated
+        proof. The points are fixed length, so the encoding is unambiguous.
+        """
+        Vs = V if isinstance(V, list) else [V]
+        return hashlib.sha256(to_bytes(bitlength, 1) + to_bytes(len(Vs), 4) +
+                              "".join([str(x) for x in Vs]) + str(proof)).digest()
+
+    def check(self, key):
+        """Returns whether the proof with this key is known to be valid.
+        """
+        with self.lock:
+            if key in self.entries:
+                #mark as most recently used
+                del self.entries[key]
+                self.entries[key] = True
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, key):
+        """Records the proof with this key as valid; only call this for
+        proofs that have been verified!
+        """
+        with self.lock:
+            if key in self.entries:
+                del self.entries[key]
+            self.entries[key] = True
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses,
+                "hit_rate": float(self.hits) / lookups if lookups else 0.0}
+
+    def save(self, filename=None):
+        """Writes the keys, least recently used first, to filename (by
+        default the one given to the constructor), replacing it atomically.
+        """
+        filename = filename if filename else self.filename
+        with self.lock:
+            body = "".join(self.entries.keys())
+        tmp = filename + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(self.magic + chr(self.version) + to_bytes(len(body) // 32, 4) +
+                    hashlib.sha256(body).digest() + body)
+        os.rename(tmp, filename)
+
+    def load(self, filename):
+        """Adds the keys saved in filename; raises ValueError if it isn't
+        a (valid, complete) cache file.
+        """
+        with open(filename, "rb") as f:
+            data = f.read()
+        header = len(self.magic) + 1 + 4 + 32
+        if not data.startswith(self.magic):
+            raise ValueError("Not a verification cache file: " + filename)
+        if len(data) < header:
+            raise ValueError("Truncated verification cache file: " + filename)
+        if ord(data[len(self.magic)]) != self.version:
+            raise ValueError("Unsupported verification cache file version: " + filename)
+        count = from_bytes(data[len(self.magic) + 1:len(self.magic) + 5])
+        body = data[header:]
+        if len(body) != 32 * count or hashlib.sha256(body).digest() != data[
+            header - 32:header]:
+            raise ValueError("Corrupted verification cache file: " + filename)
+        for i in range(0, len(body), 32):
+            self.add(body[i:i + 32])
+
+def run_test_verifycache(filename="/tmp/bp-verifycache-test"):
+    from rangeproof import RangeProof, verify_batch, verify_many
+    proofs = []
+    for v in range(4):
+        rp = RangeProof(8)
+        rp.generate_proof(v)
+        proofs.append((rp.get_proof_serialized(), rp.V, 8))
+    #an invalid proof (wrong commitment) must never be cached
+    bad = (proofs[0][0], proofs[1][1], 8)
+    cache = VerificationCache(maxsize=3, filename=filename)
+    assert verify_batch(proofs + [bad], cache=cache) == [True] * 4 + [False]
+    assert len(cache) == 3 and cache.misses == 5 and cache.hits == 0
+    assert verify_batch(proofs[1:] + [bad], cache=cache) == [True] * 3 + [False]
+    assert cache.hits == 3 and cache.misses == 6
+    assert [x[0] for x in verify_many([p[0] for p in proofs], [p[1] for p in proofs],
+                                      8, workers=2, cache=cache)] == [True] * 4
+    assert cache.hits == 6 and cache.misses == 7, cache.stats()
+    cache.save()
+    cache2 = VerificationCache(filename=filename)
+    assert cache2.entries.keys() == cache.entries.keys()
+    assert cache2.check(VerificationCache.key(*proofs[3]))
+    assert not cache2.check(VerificationCache.key(*bad))
+    #truncated files, down to just the magic, are rejected
+    with open(filename, "rb") as f:
+        data = f.read()
+    for n in [len(VerificationCache.magic), len(VerificationCache.magic) + 3, len(data) - 1]:
+        with open(filename, "wb") as f:
+            f.write(data[:n])
+        try:
+            VerificationCache(filename=filename)
+            assert False, "truncated cache file loaded"
+        except ValueError:
+            pass
+    os.remove(filename)
+    print("Verification cache test passed; stats: ", cache.stats())
+
+if __name__ == "__main__":
+    run_test_verifycache()
@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+from __future__ import print_function
+"""A local rangeproof verification service: proofs sent over a TCP or
+Unix socket are collected into micro-batches, which are verified with
+verify_batch in a process pool, and each caller gets its own result.
+The protocol is one JSON object per line each way; a request is
+{"proof": hex, "V": hex (or a list of hex, aggregated), "bitlength": n}
+and the response {"valid": true/false, "error": null or a description}.
+Batches are dispatched as soon as a worker is idle, so at low load
+a proof is verified straight away, and while all the workers are busy
+requests accumulate, up to max_batch of them or for at most max_delay
+seconds, so batching (and its saving) grows with the load.
+At most max_pending requests are queued or being verified at a time;
+beyond that a request is refused at once with error "busy", so that a
+burst can't grow the queue without bound.
+With a verifycache.VerificationCache, proofs already verified are
+answered at once, without being queued.
+Once it has a place, a request is checked as in stage 1 of
+rangeproof.verify_tiered: proofs of more than max_values values or
+max_bits bits in all, and malformed ones, are answered at once with the
+reason, so that junk never costs the workers' time or generators. The
+check of (61) (stage 2, with prefilter) is the first thing a worker does
+with each proof of a batch, so that only the proofs passing it are
+batch verified; it's an EC multiplication, so not done by the thread
+receiving the request.
+A caller waits at most timeout seconds for its result; it then gets
+error "timeout", and its place is given up (though a proof already sent
+to a worker is still verified).
+"""
+import sys
+import json
+import time
+import socket
+import argparse
+import binascii
+import threading
+import SocketServer
+import Queue
+import multiprocessing
+
+from rangeproof import (make_pool, _verify_task, verify_tiered, MAX_VALUES,
+                        MAX_PROOF_BITS)
+from verifycache import VerificationCache
+
+#requests longer than this (a hex 64 bit proof is ~1.4k) are refused
+MAX_REQUEST_BYTES = 1 << 16
+
+def _verify_shard(args):
+    """_verify_task, after (if prefilter) dropping the proofs failing
+    (61), which get that as their error; any exception is returned as
+    the error of each request: Pool.apply_async (in Python 2) has no
+    error callback, so otherwise the requests would never be answered.
+    """
+    shard, prefilter, max_values, max_bits = args
+    try:
+        results = [None] * len(shard)
+        if prefilter:
+            for i, item in enumerate(shard):
+                result = verify_tiered(*(item + (True, max_values, max_bits, 2)))
+                if not result:
+                    results[i] = (False, "{}: {}".format(result.reason, result.detail))
+        todo = [i for i in range(len(shard)) if results[i] is None]
+        if todo:
+            for i, result in zip(todo, _verify_task([shard[i] for i in todo])):
+                results[i] = result
+        return results
+    except Exception as e:
+        return [(False, "internal error: " + repr(e))] * len(shard)
+
+class _Pending(object):
+    __slots__ = ("item", "done", "result", "released")
+
+    def __init__(self, item):
+        self.item = item
+        self.done = threading.Event()
+        self.result = None
+        #whether its place in max_pending was given back
+        self.released = False
+
+class VerificationService(object):
+    """Batches and verifies the requests submitted from any number of
+    threads (see the module docstring). pool can be any object with
+    apply_async(func, args, callback=...), e.g. multiprocessing.Pool or
+    multiprocessing.pool.ThreadPool, with workers its size; by default a
+    pool of workers processes (default CPU count) is made with make_pool
+    for proofs of bitlength (other bitlengths still work, the workers
+    just derive their generators on first use). cache is an optional
+    verifycache.VerificationCache. max_values, max_bits and prefilter
+    are as for verify_tiered's max_values, max_bits and check61. timeout
+    is the most seconds submit waits for a result.
+    """
+    def __init__(self, workers=None, pool=None, max_batch=64, max_delay=0.05,
+                 max_pending=1024, bitlength=64, generator_file=None, cache=None,
+                 max_values=MAX_VALUES, max_bits=MAX_PROOF_BITS, prefilter=True,
+                 timeout=60):
+        self.nworkers = workers if workers else multiprocessing.cpu_count()
+        self.own_pool = not pool
+        self.pool = pool if pool else make_pool(self.nworkers, bitlength, 1,
+                                                generator_file)
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.cache = cache
+        self.max_values = max_values
+        self.max_bits = max_bits
+        self.prefilter = prefilter
+        self.timeout = timeout
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.inflight = 0
+        self.stats = {"requests": 0, "refused": 0, "rejected": 0, "batches": 0,
+                      "timeouts": 0}
+        self.stopped = threading.Event()
+        self.batcher = threading.Thread(target=self._run)
+        self.batcher.daemon = True
+        self.batcher.start()
+
+    def submit(self, proof, V, bitlength):
+        """Verifies the serialized proof against V (a list for an
+        aggregated proof); blocks until done, and returns (valid, error)
+        as for verify_many, or (False, "busy") if max_pending requests
+        are already waiting, or (False, "timeout") after timeout seconds.
+        A proof rejected by the checks of verify_tiered (see the module
+        docstring) gets as error its reason and detail.
+        """
+        key = self.cache.key(proof, V, bitlength) if self.cache is not None else None
+        if key and self.cache.check(key):
+            return (True, None)
+        with self.lock:
+            if self.pending >= self.max_pending or self.stopped.is_set():
+                self.stats["refused"] += 1
+                return (False, "busy")
+            self.pending += 1
+        p = _Pending((proof, V, bitlength))
+        result = verify_tiered(proof, V, bitlength, False, self.max_values,
+                               self.max_bits, last_stage=1)
+        if not result:
+            with self.lock:
+                self._release(p)
+                self.stats["rejected"] += 1
+            return (False, "{}: {}".format(result.reason, result.detail))
+        with self.lock:
+            self.stats["requests"] += 1
+        self.queue.put(p)
+        if not p.done.wait(self.timeout):
+            with self.lock:
+                #unless answered meanwhile
+                if not p.done.is_set():
+                    self._release(p)
+                    self.stats["timeouts"] += 1
+                    return (False, "timeout")
+        if key and p.result[0]:
+            self.cache.add(key)
+        return p.result
+
+    def _release(self, p):
+        #with self.lock held
+        if not p.released:
+            p.released = True
+            self.pending -= 1
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while not (self.stopped.is_set() and self.queue.empty() and not batch):
+            try:
+                p = self.queue.get(timeout=max(0, deadline - time.time()
+                                               ) if batch else 0.1)
+            except Queue.Empty:
+                p = None
+            if p:
+                if not batch:
+                    deadline = time.time() + self.max_delay
+                batch.append(p)
+                #take whatever else is waiting already
+                while len(batch) < self.max_batch:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except Queue.Empty:
+                        break
+            if batch and (len(batch) >= self.max_batch or time.time() >= deadline
+                          or self.inflight < self.nworkers or self.stopped.is_set()):
+                self._dispatch(batch)
+                batch = []
+
+    def _dispatch(self, batch):
+        with self.lock:
+            #those that timed out while queued are dropped
+            batch = [p for p in batch if not p.released]
+            if not batch:
+                return
+            self.inflight += 1
+            self.stats["batches"] += 1
+        def done(results):
+            with self.lock:
+                for p, result in zip(batch, results):
+                    p.result = result
+                    self._release(p)
+                    p.done.set()
+                self.inflight -= 1
+        try:
+            self.pool.apply_async(_verify_shard, (([p.item for p in batch], self.prefilter,
+                                                   self.max_values, self.max_bits),),
+                                  callback=done)
+        except Exception as e:
+            #e.g. the pool was closed; answer rather than leave them waiting
+            done([(False, "internal error: " + repr(e))] * len(batch))
+
+    def close(self):
+        """Stops taking requests, finishes those already taken, and
+        closes the pool if it was made here.
+        """
+        self.stopped.set()
+        self.batcher.join()
+        if self.own_pool:
+            self.pool.close()
+            self.pool.join()
+
+class _Handler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline(MAX_REQUEST_BYTES)
+            if not line:
+                return
+            if not line.endswith("\n"):
+                self._respond(False, "request too long")
+                return
+            try:
+                req = json.loads(line)
+                proof = binascii.unhexlify(req["proof"])
+                V = req["V"]
+                V = [binascii.unhexlify(x) for x in V] if isinstance(
+                    V, list) else binascii.unhexlify(V)
+                bitlength = int(req["bitlength"])
+            except (ValueError, KeyError, TypeError, OverflowError) as e:
+                self._respond(False, "bad request: " + repr(e))
+                continue
+            self._respond(*self.server.service.submit(proof, V, bitlength))
+
+    def _respond(self, valid, error):
+        self.wfile.write(json.dumps({"valid": valid, "error": error}) + "\n")
+        self.wfile.flush()
+
+class TCPVerificationServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class UnixVerificationServer(SocketServer.ThreadingMixIn,
+                             SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+def make_server(address, service):
+    """Returns a server (call serve_forever()) passing the requests on
+    address, a (host, port) tuple or a Unix socket path, to service.
+    """
+    if isinstance(address, tuple):
+        server = TCPVerificationServer(address, _Handler)
+    else:
+        server = UnixVerificationServer(address, _Handler)
+    server.service = service
+    return server
+
+def verify_remote(address, proofs):
+    """Client side: sends the (proof, V, bitlength) tuples in proofs over
+    one connection to a server at address; returns the list of
+    (valid, error) responses.
+    """
+    family = socket.AF_INET if isinstance(address, tuple) else socket.AF_UNIX
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.connect(address)
+    try:
+        f = sock.makefile("rwb")
+        results = []
+        for proof, V, bitlength in proofs:
+            Vhex = [binascii.hexlify(str(x)) for x in V] if isinstance(
+                V, list) else binascii.hexlify(str(V))
+            f.write(json.dumps({"proof": binascii.hexlify(proof), "V": Vhex,
+                                "bitlength": bitlength}) + "\n")
+            f.flush()
+            resp = json.loads(f.readline())
+            results.append((resp["valid"], resp["error"]))
+        return results
+    finally:
+        sock.close()
+
+def run_test_verifyserver(path, bitlength=8, nclients=8):
+    import os
+    from multiprocessing.pool import ThreadPool
+    from rangeproof import RangeProof
+    proofs = []
+    for v in range(nclients):
+        rp = RangeProof(bitlength)
+        rp.generate_proof(v)
+        proofs.append((rp.get_proof_serialized(), rp.V, bitlength))
+    #client i sends its proof, and then proof i+1 against its own V, invalid,
+    #which fails (61) in the worker, before the batch check
+    expected = [[(True, None), (False, "equation_61")] for _ in range(nclients)]
+    service = VerificationService(pool=ThreadPool(2), workers=2, max_delay=0.2)
+    if os.path.exists(path):
+        os.remove(path)
+    server = make_server(path, service)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    results = [None] * nclients
+    def client(i):
+        other = proofs[(i + 1) % nclients][0]
+        results[i] = verify_remote(path, [proofs[i], (other, proofs[i][1], bitlength)])
+    clients = [threading.Thread(target=client, args=(i,)) for i in range(nclients)]
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    results = [[(v, e.split(":")[0] if e else e) for v, e in r] for r in results]
+    assert results == expected, results
+    requests = service.stats["requests"]
+    bad = verify_remote(path, [("junk", proofs[0][1], bitlength)])[0]
+    assert bad[0] is False and "length" in bad[1], bad
+    #too many values, or an unparseable bitlength, are not queued either
+    bad = verify_remote(path, [(proofs[0][0], [proofs[0][1]] * 32, bitlength)])[0]
+    assert bad[0] is False and "too large" in bad[1], bad
+    bad = verify_remote(path, [(proofs[0][0], proofs[0][1], 1e400)])[0]
+    assert bad[0] is False and bad[1].startswith("bad request"), bad
+    assert service.stats["requests"] == requests, service.stats
+    #a failing worker is answered, rather than leaving the request waiting
+    global _verify_task
+    real_verify_task = _verify_task
+    def failing_task(shard):
+        raise RuntimeError("worker failed")
+    _verify_task = failing_task
+    try:
+        bad = service.submit(*proofs[0])
+    finally:
+        _verify_task = real_verify_task
+    assert bad[0] is False and "worker failed" in bad[1], bad
+    #a caller not answered in time gets "timeout", and its place back once
+    pool = ThreadPool(1)
+    slow = VerificationService(pool=pool, workers=1, timeout=0.001)
+    assert slow.submit(*proofs[0]) == (False, "timeout")
+    assert slow.pending == 0 and slow.stats["timeouts"] == 1, slow.stats
+    slow.close()
+    pool.close()
+    pool.join()
+    assert slow.pending == 0, slow.pending
+    server.shutdown()
+    server.server_close()
+    service.close()
+    os.remove(path)
+    print("Verification service test passed; stats: ", service.stats)
+
+def main():
+    parser = argparse.ArgumentParser(description="Rangeproof verification service")
+    parser.add_argument("--unix", help="Unix socket path to listen on")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8555)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--bitlength", type=int, default=64,
+                        help="bitlength the workers' generators are prepared for")
+    parser.add_argument("--generator-file", default=None)
+    parser.add_argument("--max-batch", type=int, default=64)
+    parser.add_argument("--max-delay", type=float, default=0.05,
+                        help="seconds a request may wait to be batched")
+    parser.add_argument("--max-pending", type=int, default=1024)
+    parser.add_argument("--max-values", type=int, default=MAX_VALUES,
+                        help="most values in an aggregated proof accepted")
+    parser.add_argument("--max-bits", type=int, default=MAX_PROOF_BITS,
+                        help="most bits (bitlength times values) in a proof accepted")
+    parser.add_argument("--no-prefilter", action="store_true",
+                        help="don't check (61) before queueing a proof")
+    parser.add_argument("--timeout", type=float, default=60,
+                        help="seconds a request may wait for its result")
+    parser.add_argument("--cache-size", type=int, default=0,
+                        help="number of verified proofs to remember (0: no cache)")
+    parser.add_argument("--cache-file", default=None,
+                        help="file the cache is loaded from and saved to on exit")
+    parser.add_argument("--test", action="store_true",
+                        help="run a self test on the --unix path")
+    args = parser.parse_args()
+    if args.test:
+        run_test_verifyserver(args.unix if args.unix else "/tmp/bp-verify-test.sock")
+        return
+    cache = VerificationCache(args.cache_size, args.cache_file) if args.cache_size else None
+    service = VerificationService(args.workers, None, args.max_batch, args.max_delay,
+                                  args.max_pending, args.bitlength, args.generator_file,
+                                  cache, args.max_values, args.max_bits,
+                                  not args.no_prefilter, args.timeout)
+    server = make_server(args.unix if args.unix else (args.host, args.port), service)
+    print("Listening on", server.server_address, file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if cache is not None and args.cache_file:
+            cache.save()
+
+if __name__ == "__main__":
+    main()